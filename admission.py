@@ -0,0 +1,207 @@
+"""
+Copyright 2014 VoterChat
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import math
+import time
+from collections import Counter
+
+from flask import jsonify, request
+
+import config
+import logs
+
+# Buckets are stored next to the user or group they limit, so that they are
+# spread across the nodes like the users and groups. They are named after
+# their kind, "user" or "group", and the name of the user or group.
+BUCKET = "%s:{%s}:bucket"
+
+# Takes tokens from token buckets if all of them hold enough. KEYS are the
+# buckets, hashes of the tokens they held and the time they were updated
+# at. ARGV[1] is the current time in milliseconds since the epoch, followed
+# by the rate in tokens per second, the burst and the cost of every bucket.
+# A cost above the burst takes a full bucket, and a negative cost gives
+# tokens back, up to the burst. Buckets are written only if all of them
+# admit the request, and expire once they would be full again.
+# Returns 0 if the request is admitted, or the milliseconds until it would
+# be. All of the buckets have to be stored on the same node. Registered by
+# `install` on the client it is given.
+_ADMIT = """
+local now = tonumber(ARGV[1])
+local levels = {}
+local wait = 0
+for i = 1, #KEYS do
+    local rate = tonumber(ARGV[i * 3 - 1])
+    local burst = tonumber(ARGV[i * 3])
+    local cost = math.min(tonumber(ARGV[i * 3 + 1]), burst)
+    local bucket = redis.call("HMGET", KEYS[i], "tokens", "stamp")
+    local level = burst
+    if bucket[1] then
+        local elapsed = math.max(0, now - tonumber(bucket[2]))
+        level = math.min(burst, tonumber(bucket[1]) + elapsed * rate / 1000)
+    end
+    levels[i] = level
+    if level < cost then
+        wait = math.max(wait, math.ceil((cost - level) * 1000 / rate))
+    end
+end
+if wait > 0 then
+    return wait
+end
+for i = 1, #KEYS do
+    local rate = tonumber(ARGV[i * 3 - 1])
+    local burst = tonumber(ARGV[i * 3])
+    local cost = math.min(tonumber(ARGV[i * 3 + 1]), burst)
+    local tokens = math.min(burst, levels[i] - cost)
+    redis.call("HMSET", KEYS[i], "tokens", tokens, "stamp", now)
+    redis.call("PEXPIRE", KEYS[i], math.ceil(burst * 1000 / rate))
+end
+return 0
+"""
+
+_counts = Counter()
+
+def buckets():
+    """
+    Returns the buckets of the user and the groups the current
+    request is made for, as (kind, name) pairs mapped to the
+    number of tokens it takes from them.
+
+    The user is the 'username' of the URL, the form or the JSON
+    body, and the group is the 'groupname' of the URL. Requests
+    to /api/send take a token for every message they send, from
+    the sender and from the group of every message sent to one.
+    """
+    view_args = request.view_args or {}
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        data = {}
+    username = (
+        view_args.get("username")
+        or request.form.get("username")
+        or data.get("username")
+    )
+    if not isinstance(username, basestring):
+        # Left for the route to refuse.
+        username = None
+
+    costs = Counter()
+    messages = data.get("messages")
+    if isinstance(messages, list) and messages:
+        for message in messages:
+            if not isinstance(message, dict):
+                continue
+            group = message.get("group")
+            if group and isinstance(group, basestring):
+                costs[("group", group)] += 1
+        if username:
+            costs[("user", username)] += len(messages)
+    elif username:
+        costs[("user", username)] += 1
+    if view_args.get("groupname"):
+        costs[("group", view_args["groupname"])] += 1
+    return costs
+
+def admit(client, script, costs, now=None):
+    """
+    Takes tokens from buckets. Returns 0 if the request is
+    admitted, or the seconds until it would be.
+
+    Buckets are checked in one round trip to every node they
+    are stored on, starting with the node of the user, so that
+    an admitted request costs as many round trips as there are
+    nodes. Buckets on the nodes checked before the one which
+    refuses a request have already been taken from, and are
+    given their tokens back in one more round trip to each of
+    those nodes. A request refused by the first node costs
+    one round trip.
+
+    Parameters:
+    * client - Client of the nodes the buckets are stored on.
+    * script - `_ADMIT` registered on the client.
+    * costs - Mapping from the buckets to the number of tokens
+              taken from them, as returned by `buckets`.
+    """
+    now = now or int(time.time() * 1000)
+    limited = []
+    for (kind, name), cost in costs.iteritems():
+        limit = config.ADMISSION_LIMITS[kind]
+        if limit["rate"] > 0:
+            limited.append(
+                (kind != "user", BUCKET % (kind, name), limit["rate"],
+                 limit["burst"], cost)
+            )
+    # The bucket of the user comes first, so its node is checked first.
+    limited.sort()
+
+    taken = []
+    for node, step in client.partition(limited, key=lambda b: b[1]):
+        wait = _run(node, script, step, now)
+        if wait:
+            for node, step in taken:
+                _run(node, script, step, now, refund=True)
+            return int(math.ceil(wait / 1000.0))
+        taken.append((node, step))
+    return 0
+
+def _run(node, script, step, now, refund=False):
+    """
+    Runs `_ADMIT` on the buckets of a node, or gives
+    their tokens back if `refund` is set.
+    """
+    args = [now]
+    for _, _, rate, burst, cost in step:
+        args.extend((rate, burst, -cost if refund else cost))
+    return script(keys=[bucket[1] for bucket in step], args=args, client=node)
+
+def install(app, client):
+    """
+    Admits the requests to the routes in `config.ADMISSION_ROUTES`
+    before they are handled, with buckets stored by `client`, a
+    `shards.ShardedRedis`. Requests refused are answered with 429
+    and a Retry-After header, see `admit`.
+
+    The client is passed in rather than imported from main, so that
+    this module can be installed while main is still being loaded.
+    """
+    script = client.register_script(_ADMIT)
+
+    @app.before_request
+    def admit_request():
+        if request.endpoint not in config.ADMISSION_ROUTES:
+            return None
+        costs = buckets()
+        wait = admit(client, script, costs)
+        if not wait:
+            _counts["admitted"] += 1
+            return None
+
+        _counts["refused"] += 1
+        logs.event("refused", route=request.endpoint,
+                   buckets=["%s:%s" % bucket for bucket in sorted(costs)],
+                   retry_after=wait)
+        response = jsonify({
+            "message": "Too many requests, retry in %d seconds." % wait
+        })
+        response.status_code = 429
+        response.headers["Retry-After"] = str(wait)
+        return response
+
+def stats():
+    """
+    Returns the number of requests admitted and refused
+    by this process.
+    """
+    return {"admitted": _counts["admitted"], "refused": _counts["refused"]}
@@ -0,0 +1,111 @@
+"""
+Copyright 2014 VoterChat
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+# Microbenchmarks of the hot paths of the models against a local Redis.
+#
+#   python benchmarks/bench_models.py --db 15
+#
+# The database given by --db is flushed, so do not point this at a
+# database holding real data.
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import config
+from common import CommandCounter, Result, report, timed
+
+def run(models, name, ops):
+    """
+    Times every operation and counts the commands they send.
+    """
+    latencies = []
+    with CommandCounter(*models.r.nodes()) as counter:
+        start = time.time()
+        for op in ops:
+            timed(op, latencies)
+        elapsed = time.time() - start
+    return Result(name, latencies, elapsed, counter.count)
+
+def new_users(models, prefix, n):
+    users = []
+    for i in range(n):
+        user = models.User("%s%d" % (prefix, i), email="%s%d@example.com" % (prefix, i))
+        user.new()
+        users.append(user.id)
+    return users
+
+def new_message(models, sender):
+    msg = models.Message(models.new_id("message"), sender=sender, content="Hey Dude!")
+    msg.new()
+    return msg
+
+def bench_new(models, args):
+    ops = [
+        models.User("new%d" % i, email="new%d@example.com" % i).new
+        for i in range(args.n)
+    ]
+    return run(models, "DBModel.new", ops)
+
+def bench_send_users(models, args):
+    users = new_users(models, "send", args.recipients)
+    msgs = [new_message(models, users[0]) for _ in range(args.n)]
+    ops = [lambda msg=msg: msg.send_users(users) for msg in msgs]
+    return run(models, "Message.send_users (%d)" % args.recipients, ops)
+
+def bench_poll(models, args):
+    users = new_users(models, "poll", args.n)
+    for _ in range(args.backlog):
+        new_message(models, users[0]).send_users(users)
+    ops = [models.User(username).poll for username in users]
+    return run(models, "User.poll (%d queued)" % args.backlog, ops)
+
+def bench_recieved(models, args):
+    users = new_users(models, "recieved", 1)
+    msgs = []
+    for _ in range(args.n):
+        msg = new_message(models, users[0])
+        msg.send_users(users)
+        msgs.append(msg)
+    return run(models, "Message.recieved", [msg.recieved for msg in msgs])
+
+BENCHMARKS = [bench_new, bench_send_users, bench_poll, bench_recieved]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--db", type=int, default=15,
+                        help="Redis database to flush and use.")
+    parser.add_argument("--n", type=int, default=1000,
+                        help="Operations per benchmark.")
+    parser.add_argument("--recipients", type=int, default=100,
+                        help="Recipients per message for send_users.")
+    parser.add_argument("--backlog", type=int, default=100,
+                        help="Queued messages per user for poll.")
+    args = parser.parse_args()
+
+    # The models connect using the config when they are imported.
+    config.REDIS_NODES = [dict(node, db=args.db) for node in config.REDIS_NODES]
+    import models
+
+    results = []
+    for benchmark in BENCHMARKS:
+        models.r.flushdb()
+        models.flushdb()
+        results.append(benchmark(models, args))
+    report(results)
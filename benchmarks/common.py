@@ -0,0 +1,98 @@
+"""
+Copyright 2014 VoterChat
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+# Helpers shared by the benchmarks.
+
+import time
+
+def percentile(values, p):
+    """
+    Returns the p-th percentile of the values.
+    """
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+class CommandCounter(object):
+    """
+    Counts the commands Redis servers execute, using the
+    calls reported by INFO commandstats. Commands called from
+    Lua scripts are counted as well.
+    """
+
+    def __init__(self, *clients):
+        self.clients = clients
+        self.start = 0
+
+    def total(self):
+        total = 0
+        for client in self.clients:
+            stats = client.info("commandstats")
+            total += sum(stat["calls"] for stat in stats.values())
+        return total
+
+    def __enter__(self):
+        self.start = self.total()
+        return self
+
+    def __exit__(self, *exc_info):
+        # The INFO sent to every server by total() is counted too.
+        self.count = self.total() - self.start - len(self.clients)
+
+class Result(object):
+    """
+    Throughput, latencies and commands of a benchmark run.
+    """
+
+    def __init__(self, name, latencies, elapsed, commands=None):
+        self.name = name
+        self.latencies = latencies
+        self.elapsed = elapsed
+        self.commands = commands
+
+    def row(self):
+        ops = len(self.latencies)
+        commands = "-"
+        if self.commands is not None and ops:
+            commands = "%.1f" % (float(self.commands) / ops)
+        return "%-28s %8d %12.1f %10.2f %10.2f %12s" % (
+            self.name,
+            ops,
+            ops / self.elapsed if self.elapsed else 0.0,
+            percentile(self.latencies, 50) * 1000,
+            percentile(self.latencies, 99) * 1000,
+            commands
+        )
+
+def report(results):
+    """
+    Prints a table of benchmark results.
+    """
+    print "%-28s %8s %12s %10s %10s %12s" % (
+        "benchmark", "ops", "ops/s", "p50 ms", "p99 ms", "commands/op"
+    )
+    for result in results:
+        print result.row()
+
+def timed(op, latencies):
+    """
+    Runs the operation and appends its latency.
+    """
+    start = time.time()
+    result = op()
+    latencies.append(time.time() - start)
+    return result
@@ -0,0 +1,114 @@
+"""
+Copyright 2014 VoterChat
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+# Compares the throughput of servers running the API under the same load.
+#
+# Start the servers against a local Redis, for example:
+#   python main.py                (Flask development server, port 5000)
+#   python serve.py               (gevent server, SERVER_PORT in config.py)
+#
+# Then run:
+#   python benchmarks/compare_servers.py http://localhost:5000 http://localhost:5001
+#
+# Every server is flushed, gets its own users and is then sent messages
+# by `--clients` threads while `--parked` clients wait on long polls.
+
+import argparse
+import random
+import threading
+import time
+
+import requests
+
+from common import percentile
+
+def setup(url, users):
+    session = requests.Session()
+    session.get("%s/api/flushdb" % url).raise_for_status()
+    for i in range(users):
+        session.post(
+            "%s/api/user/bench%d/new" % (url, i),
+            data={"email": "bench%d@example.com" % i}
+        ).raise_for_status()
+
+def park(url, username, stop):
+    session = requests.Session()
+    while not stop.is_set():
+        session.post(
+            "%s/api/poll" % url,
+            data={"username": username, "wait": 5}
+        )
+
+def client(url, users, requests_per_client, latencies):
+    session = requests.Session()
+    for _ in range(requests_per_client):
+        sender, recipient = random.sample(range(users), 2)
+        start = time.time()
+        session.post(
+            "%s/api/user/bench%d/send" % (url, recipient),
+            data={"username": "bench%d" % sender, "content": "Hello!"}
+        )
+        session.post("%s/api/poll" % url, data={"username": "bench%d" % sender})
+        latencies.append(time.time() - start)
+
+def run(url, args):
+    setup(url, args.users + args.parked)
+
+    stop = threading.Event()
+    parked = [
+        threading.Thread(target=park, args=(url, "bench%d" % i, stop))
+        for i in range(args.users, args.users + args.parked)
+    ]
+    for thread in parked:
+        thread.daemon = True
+        thread.start()
+
+    latencies = []
+    clients = [
+        threading.Thread(
+            target=client,
+            args=(url, args.users, args.requests, latencies)
+        )
+        for _ in range(args.clients)
+    ]
+    start = time.time()
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    elapsed = time.time() - start
+    stop.set()
+
+    return (
+        len(latencies) / elapsed,
+        percentile(latencies, 50) * 1000,
+        percentile(latencies, 99) * 1000
+    )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("urls", nargs="+", help="Base URLs of the servers.")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--clients", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=50,
+                        help="Send and poll pairs per client.")
+    parser.add_argument("--parked", type=int, default=100,
+                        help="Clients waiting on long polls.")
+    args = parser.parse_args()
+
+    print "%-30s %12s %10s %10s" % ("server", "pairs/s", "p50 ms", "p99 ms")
+    for url in args.urls:
+        print "%-30s %12.1f %10.1f %10.1f" % ((url,) + run(url, args))
@@ -0,0 +1,141 @@
+"""
+Copyright 2014 VoterChat
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+# Headless load generator for the HTTP API.
+#
+#   python benchmarks/loadgen.py http://localhost:5000 --users 1000 --groups 50
+#
+# Creates --users users split across --groups groups, then runs
+# --concurrency clients for --duration seconds. Every client picks a
+# random user, sends a message to another member of one of their groups
+# through /api/user/<recipient>/send and polls the recipient through
+# /api/poll. If --redis is given, the commands Redis executed are
+# counted and reported per request.
+
+import argparse
+import random
+import threading
+import time
+
+import redis
+import requests
+
+from common import CommandCounter, Result, report, timed
+
+def setup(url, users, groups):
+    """
+    Creates the users and groups. Returns the groups
+    as lists of usernames.
+    """
+    session = requests.Session()
+    session.get("%s/api/flushdb" % url).raise_for_status()
+    members = [[] for _ in range(groups)]
+    for i in range(users):
+        username = "load%d" % i
+        session.post(
+            "%s/api/user/%s/new" % (url, username),
+            data={"email": "%s@example.com" % username}
+        ).raise_for_status()
+        members[i % groups].append(username)
+
+    for i, usernames in enumerate(members):
+        groupname = "group%d" % i
+        session.post(
+            "%s/api/group/%s/new" % (url, groupname),
+            data={"username": usernames[0]}
+        ).raise_for_status()
+        # Members join by election: every user asks to be invited and
+        # the members vote yes until the turnout concludes the election.
+        for i, username in enumerate(usernames[1:], 1):
+            session.post(
+                "%s/api/group/%s/invite" % (url, groupname),
+                data={"username": username, "candidate": username}
+            ).raise_for_status()
+            for member in usernames[:i]:
+                response = session.post(
+                    "%s/api/group/%s/vote" % (url, groupname),
+                    data={"username": member, "candidate": username,
+                          "vote": "yes"}
+                )
+                response.raise_for_status()
+                if response.json()["result"] != "counted":
+                    break
+    return [usernames for usernames in members if len(usernames) > 1]
+
+def client(url, groups, until, sends, polls, errors):
+    session = requests.Session()
+    while time.time() < until:
+        sender, recipient = random.sample(random.choice(groups), 2)
+        response = timed(lambda: session.post(
+            "%s/api/user/%s/send" % (url, recipient),
+            data={"username": sender, "content": "Hey Dude!"}
+        ), sends)
+        if response.status_code != 200:
+            errors.append(response.status_code)
+        response = timed(lambda: session.post(
+            "%s/api/poll" % url,
+            data={"username": recipient}
+        ), polls)
+        if response.status_code != 200:
+            errors.append(response.status_code)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("url", help="Base URL of the server.")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--groups", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--redis", metavar="HOST:PORT",
+                        help="Redis server of the API, to count commands.")
+    args = parser.parse_args()
+
+    groups = setup(args.url, args.users, args.groups)
+
+    counter = None
+    if args.redis:
+        host, port = args.redis.split(":")
+        counter = CommandCounter(redis.StrictRedis(host=host, port=int(port)))
+        counter.__enter__()
+
+    sends, polls, errors = [], [], []
+    until = time.time() + args.duration
+    clients = [
+        threading.Thread(
+            target=client,
+            args=(args.url, groups, until, sends, polls, errors)
+        )
+        for _ in range(args.concurrency)
+    ]
+    start = time.time()
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    elapsed = time.time() - start
+
+    # Commands can only be counted for both endpoints together.
+    commands = None
+    if counter:
+        counter.__exit__(None, None, None)
+        commands = counter.count
+    report([
+        Result("POST /api/user/<id>/send", sends, elapsed),
+        Result("POST /api/poll", polls, elapsed),
+        Result("all requests", sends + polls, elapsed, commands)
+    ])
+    if errors:
+        print "%d request(s) failed." % len(errors)
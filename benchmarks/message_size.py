@@ -0,0 +1,78 @@
+"""
+Copyright 2014 VoterChat
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+# Compares the bytes per message and the encode/decode time of the
+# message serializers, for short and long content.
+#
+#   python benchmarks/message_size.py
+#
+# Sizes of "hash" are the field names and values only. Redis adds its
+# own per-field and per-key overhead on top of them.
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import serializers
+
+CONTENTS = {
+    "short": u"Hey Dude!",
+    "long": u"Hey Guys! How are you doing? " * 40
+}
+
+def sample(content):
+    return {
+        "sender": u"alice",
+        "content": content,
+        "stamp": 1410010951000,
+        "group": u"friends"
+    }
+
+def hash_size(fields):
+    return sum(len(k) + len(serializers.encode(v)) for k, v in fields.items())
+
+def candidates():
+    yield "hash", None
+    for name in ("struct", "msgpack"):
+        for compression in (None, "zlib", "lz4"):
+            try:
+                yield name, serializers.get_serializer(name, compression, 256)
+            except ImportError:
+                pass
+
+if __name__ == "__main__":
+    number = 10000
+    print "%-8s %-16s %8s %12s %12s" % (
+        "content", "serializer", "bytes", "encode us", "decode us"
+    )
+    for label, content in sorted(CONTENTS.items()):
+        fields = sample(content)
+        for name, serializer in candidates():
+            if serializer is None:
+                print "%-8s %-16s %8d %12s %12s" % (
+                    label, name, hash_size(fields), "-", "-"
+                )
+                continue
+            value = serializer.dumps(fields)
+            encode = timeit.timeit(lambda: serializer.dumps(fields), number=number)
+            decode = timeit.timeit(lambda: serializers.loads(value), number=number)
+            compression = {0: "", 1: "+zlib", 2: "+lz4"}[serializer.compression]
+            print "%-8s %-16s %8d %12.2f %12.2f" % (
+                label, name + compression, len(value),
+                encode / number * 1e6, decode / number * 1e6
+            )
@@ -0,0 +1,94 @@
+"""
+Copyright 2014 VoterChat
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+# Compares ways for the prototype client to send a message and poll.
+#
+#   python prototypes/messaging/server.py
+#   python benchmarks/prototype_batch.py http://localhost:8080/api
+#
+# Every operation sends a message to a group and polls for replies:
+#   connections - two requests, each on a new connection, as the client
+#                 used to send them
+#   session     - two requests on one keep-alive connection
+#   batched     - both commands in one request on a keep-alive connection
+# On a link with a round trip time of R, batching saves about R per
+# operation and keep-alive saves the connection setup of both requests,
+# so run this across the network to see the difference on real links.
+
+import argparse
+import json
+import random
+import time
+
+import requests
+
+from common import Result, report, timed
+
+HEADERS = {"Content-type": "application/json", "Accept": "application/json"}
+
+def command(user, name, **data):
+    data.update({"user": user, "command": name})
+    return data
+
+def setup(url, group):
+    """
+    Creates the group and returns the name of its member.
+    """
+    user = "bench%d" % random.randint(0, 10 ** 6)
+    requests.post(
+        url, data=json.dumps(command(user, "join", group=group)),
+        headers=HEADERS
+    ).raise_for_status()
+    return user
+
+def run(name, url, user, group, ops):
+    session = requests.Session()
+    session.headers.update(HEADERS)
+    send = command(user, "send", group=group, message="Hello!")
+    poll = command(user, "poll")
+
+    def connections():
+        requests.post(url, data=json.dumps(send), headers=HEADERS)
+        requests.post(url, data=json.dumps(poll), headers=HEADERS)
+
+    def keepalive():
+        session.post(url, data=json.dumps(send))
+        session.post(url, data=json.dumps(poll))
+
+    def batched():
+        session.post(url, data=json.dumps([send, poll]))
+
+    op = {"connections": connections, "session": keepalive,
+          "batched": batched}[name]
+    latencies = []
+    start = time.time()
+    for _ in range(ops):
+        timed(op, latencies)
+    return Result(name, latencies, time.time() - start)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("url", help="URL of the API of the prototype server.")
+    parser.add_argument("--ops", type=int, default=500,
+                        help="Operations per benchmark.")
+    args = parser.parse_args()
+
+    group = "bench%d" % random.randint(0, 10 ** 6)
+    user = setup(args.url, group)
+    report([
+        run(name, args.url, user, group, args.ops)
+        for name in ("connections", "session", "batched")
+    ])
@@ -0,0 +1,115 @@
+"""
+Copyright 2014 VoterChat
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from main import r
+import notify
+
+class Cache(object):
+    """
+    In-process LRU cache whose entries expire after a TTL.
+
+    Entries are invalidated in every process by publishing
+    their key on the cache's notification channel.
+    """
+
+    def __init__(self, name, size, ttl):
+        """
+        Creates a cache given the following parameters:
+        * name - Name of the cache, used for its channel.
+        * size - Maximum number of entries. 0 disables the cache.
+        * ttl - Seconds an entry is used for before it is reloaded.
+        """
+        self.name = name
+        self.size = size
+        self.ttl = ttl
+        self.channel = notify.channel("invalidate:%s" % name)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.listening = False
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """
+        Returns the cached value of the key, or None.
+        """
+        if not self.size:
+            return None
+        now = time.time()
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] < now:
+                self.misses += 1
+                return None
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        """
+        Caches the value of the key.
+        """
+        if not self.size:
+            return
+        if not self.listening:
+            self.listening = True
+            notify.notifier.on(self.channel, self.evict)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.ttl, value)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def evict(self, key):
+        """
+        Removes the key from this process' cache.
+        If the key is None, the cache is cleared.
+        """
+        with self.lock:
+            self.invalidations += 1
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+
+    def invalidate(self, key, pipe=None):
+        """
+        Removes the key from the cache of every process.
+
+        Parameters:
+        * pipe - Pipeline to publish the invalidation on.
+                 Default is to publish it immediately.
+        """
+        self.evict(key)
+        (pipe or r).publish(self.channel, key)
+
+    def stats(self):
+        """
+        Returns the hit, miss and invalidation counters.
+        """
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations
+            }
@@ -0,0 +1,251 @@
+"""
+Copyright 2014 VoterChat
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import time
+
+import config
+import ids
+import logs
+import models
+import shards
+from main import r
+
+# The keys of the compactor share a hash tag, so they are on the same node.
+STATS = "compactor:{compactor}:stats" # Counters of all runs
+LOCK = "compactor:{compactor}:lock"
+# Mapping from message ID -> number of queues it is in. Like
+# `models.DEADLINES`, it exists on every node and holds the messages stored
+# on that node, so it has at most one field per message older than the
+# cutoff of the run, spread across the nodes like the messages.
+REFS = "compactor:refs"
+
+# Lowers the counters of messages to the number of queues they are in, if
+# they are higher. KEYS are the counters and ARGV the numbers of queues.
+# Returns the number of counters lowered. A counter is only lowered once,
+# even if its message was returned twice by SCAN.
+_fix_counts = r.register_script("""
+local fixed = 0
+for i = 1, #KEYS do
+    local count = tonumber(redis.call("GET", KEYS[i]))
+    if count and count > tonumber(ARGV[i]) then
+        redis.call("DECRBY", KEYS[i], count - tonumber(ARGV[i]))
+        fixed = fixed + 1
+    end
+end
+return fixed
+""")
+
+class Compactor(object):
+    """
+    Reclaims messages which can no longer be recieved.
+
+    A run first counts the references to every message from the
+    queues of users and groups, then scans the messages. Messages
+    which are not in any queue are deleted, and counters higher
+    than the number of queues a message is in are lowered, so that
+    the message is deleted once the remaining recipients recieve it.
+
+    The keyspace of every node is scanned with SCAN, `batch` keys
+    at a time, and every queue is read `batch` entries at a time,
+    see `read_queue`. The references are counted in `REFS` on the
+    node of every message.
+    """
+
+    def __init__(self, batch=None, grace=None):
+        self.batch = batch or config.COMPACTOR_BATCH
+        self.grace = config.COMPACTOR_GRACE if grace is None else grace
+
+    def run(self):
+        """
+        Runs the compactor once, unless another process is running it.
+        Returns the counters of this run, or None if it did not run.
+        """
+        if not r.set(LOCK, 1, nx=True, ex=config.COMPACTOR_INTERVAL):
+            return None
+        try:
+            # Messages created after this may not have been queued yet.
+            cutoff = ids.first_id(models.timestamp())
+            time.sleep(self.grace)
+            for client in r.nodes():
+                client.delete(REFS)
+            self.drain()
+            self.mark(cutoff)
+            counters = self.sweep(cutoff)
+        finally:
+            for client in r.nodes():
+                client.delete(REFS)
+            r.delete(LOCK)
+
+        pipe = r.pipeline(STATS, transaction=False)
+        for name, value in counters.iteritems():
+            pipe.hincrby(STATS, name, value)
+        pipe.execute()
+        return counters
+
+    def drain(self):
+        """
+        Drains the queues of deleted users left behind
+        by deletes which were interrupted.
+        """
+        for client in r.nodes():
+            pattern = "user:*:queue:deleted:*"
+            for key in client.scan_iter(pattern, count=self.batch):
+                models.drain_queue(key)
+
+    def mark(self, cutoff):
+        """
+        Counts the references to messages with IDs lower than
+        `cutoff` from all queues. Newer messages are not swept.
+        """
+        patterns = ("user:*:queue", "user:*:queue:deleted:*", "group:*:queue")
+        for client in r.nodes():
+            for pattern in patterns:
+                for key in client.scan_iter(pattern, count=self.batch):
+                    for msg_ids in self.read_queue(client, key):
+                        self.mark_batch(msg_ids, cutoff)
+
+    def read_queue(self, client, key):
+        """
+        Yields the message IDs in a queue, `batch` at a time.
+
+        The queues of users are sorted sets, which are scanned.
+        A scan returns every entry which is in the set for its
+        whole duration, and may return some entries twice.
+
+        Group queues are only popped from the front and pushed to
+        at the back, so they are read from the back. An entry popped
+        while the queue is read has been recieved, and an entry
+        pushed moves the entries not read yet further back, so that
+        some are read twice.
+
+        No entry still in a queue is missed, and messages read
+        twice are only kept until the next run.
+        """
+        if key.startswith("user:"):
+            msg_ids = []
+            for msg_id, _ in client.zscan_iter(key, count=self.batch):
+                msg_ids.append(msg_id)
+                if len(msg_ids) == self.batch:
+                    yield msg_ids
+                    msg_ids = []
+            if msg_ids:
+                yield msg_ids
+            return
+
+        end = 0
+        while True:
+            msg_ids = client.lrange(key, -(end + self.batch), -(end + 1))
+            if msg_ids:
+                yield msg_ids
+            if len(msg_ids) < self.batch:
+                break
+            end += self.batch
+
+    def mark_batch(self, msg_ids, cutoff):
+        msg_ids = [
+            msg_id for msg_id in msg_ids
+            if msg_id.isdigit() and int(msg_id) < cutoff
+        ]
+        nodes = r.partition(
+            msg_ids, key=lambda msg_id: models.Message(msg_id).key
+        )
+        for client, node_ids in nodes:
+            pipe = client.pipeline(transaction=False)
+            for msg_id in node_ids:
+                pipe.hincrby(REFS, msg_id, 1)
+            pipe.execute()
+
+    def sweep(self, cutoff):
+        """
+        Deletes the messages with IDs lower than `cutoff` which are
+        not in any queue, and lowers counters which are higher than
+        the number of queues their message is in. Returns the
+        counters of the run.
+
+        Only the keys of messages are matched, not their counters,
+        so that every message is swept once. Messages SCAN returns
+        twice are not counted twice, see `sweep_batch`.
+        """
+        counters = {"scanned": 0, "reclaimed": 0, "reclaimed_bytes": 0,
+                    "fixed_counts": 0}
+        for client in r.nodes():
+            batch = set()
+            for key in client.scan_iter("message:{*}", count=self.batch):
+                msg_id = shards.hash_tag(key)
+                if msg_id.isdigit() and int(msg_id) < cutoff:
+                    batch.add(msg_id)
+                if len(batch) >= self.batch:
+                    self.sweep_batch(client, batch, counters)
+                    batch = set()
+            if batch:
+                self.sweep_batch(client, batch, counters)
+        return counters
+
+    def sweep_batch(self, client, msg_ids, counters):
+        """
+        Sweeps a batch of messages stored on a node. Only the
+        messages reclaimed are measured, and they are counted by
+        whether they were deleted, so a message swept twice is
+        only counted once.
+        """
+        msg_ids = sorted(msg_ids)
+        all_refs = client.hmget(REFS, msg_ids)
+        counters["scanned"] += len(msg_ids)
+
+        pipe = client.pipeline(transaction=False)
+        counts = []
+        refs = []
+        for msg_id, msg_refs in zip(msg_ids, all_refs):
+            key = models.Message(msg_id).key
+            if msg_refs:
+                counts.append("%s:count" % key)
+                refs.append(msg_refs)
+                continue
+            pipe.execute_command("MEMORY", "USAGE", key)
+            pipe.execute_command("MEMORY", "USAGE", "%s:count" % key)
+            pipe.delete(key, "%s:count" % key)
+        results = pipe.execute()
+        for i in range(0, len(results), 3):
+            size, count_size, deleted = results[i:i + 3]
+            if deleted:
+                counters["reclaimed"] += 1
+                counters["reclaimed_bytes"] += (size or 0) + (count_size or 0)
+
+        if counts:
+            counters["fixed_counts"] += _fix_counts(
+                keys=counts, args=refs, client=client
+            )
+
+    def run_forever(self):
+        """
+        Runs the compactor every `config.COMPACTOR_INTERVAL` seconds.
+        """
+        while True:
+            counters = self.run()
+            if counters:
+                logs.event("compactor", **counters)
+            time.sleep(config.COMPACTOR_INTERVAL)
+
+def stats():
+    """
+    Returns the counters of all runs of the compactor.
+    """
+    return dict(
+        (name, int(value)) for name, value in r.hgetall(STATS).iteritems()
+    )
+
+if __name__ == "__main__":
+    Compactor().run_forever()
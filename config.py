@@ -19,8 +19,176 @@ DEBUG = True
 SECRET_KEY = "development key"
 ### FLASK CONFIG ###
 
+### SERVER CONFIG ###
+# Address the gevent server in serve.py listens on.
+SERVER_HOST = "0.0.0.0"
+SERVER_PORT = 5000
+### SERVER CONFIG ###
+
 ### REDIS CONFIG ###
 REDIS_HOST = "localhost"
 REDIS_PORT = 6379
 REDIS_DB = 0
+# Nodes users, groups and messages are spread across by consistent
+# hashing. Every node needs a unique "id", which places it on the hash
+# ring, so the ID of a node must not be changed or given to another node.
+REDIS_NODES = [
+    {"id": 0, "host": REDIS_HOST, "port": REDIS_PORT, "db": REDIS_DB},
+]
+# Connections are shared by all requests of a process. Requests wait
+# up to REDIS_POOL_TIMEOUT seconds for a connection when all are in use.
+REDIS_MAX_CONNECTIONS = 50
+REDIS_POOL_TIMEOUT = 5
 ### REDIS CONFIG ###
+
+### LOG CONFIG ###
+# Records are written by a background thread from a queue of at most
+# LOG_QUEUE_SIZE records. Records are dropped while the queue is full.
+LOG_QUEUE_SIZE = 10000
+# File records are written to, or None for stderr.
+LOG_FILE = None
+# Level and fraction of events logged, from 0 to 1, unless set below.
+LOG_LEVEL = "INFO"
+LOG_SAMPLE_RATE = 1
+# Level and sample rate of events by name. Requests are logged as an
+# event named after the function of their route in main.py.
+LOG_ROUTES = {
+    "poll": {"sample": 0.01},
+    "get_messages": {"sample": 0.01},
+    "ack_messages": {"sample": 0.01},
+    "send": {"sample": 0.1},
+    "send_user": {"sample": 0.1},
+    "send_group": {"sample": 0.1},
+    "refused": {"sample": 0.01},
+    # Profiles are already sampled by PROFILE_SAMPLE_RATE.
+    "profile": {"sample": 1},
+}
+### LOG CONFIG ###
+
+### METRICS CONFIG ###
+# Requests taking at least this many seconds are logged as slow,
+# with the Redis commands they sent.
+SLOW_REQUEST_SECONDS = 0.5
+# Fraction of requests profiled with cProfile, from 0 to 1. The
+# PROFILE_TOP functions with the most cumulative time are logged.
+PROFILE_SAMPLE_RATE = 0
+PROFILE_TOP = 20
+### METRICS CONFIG ###
+
+### POLL CONFIG ###
+# Number of messages popped from a queue per round trip.
+POLL_BATCH_SIZE = 100
+# Maximum number of seconds a poll request may wait for messages.
+POLL_MAX_WAIT = 30
+# Number of messages read from a queue by /api/user/<username>/messages
+# if the request does not set a limit, and the highest limit it may set.
+READ_DEFAULT_LIMIT = 50
+READ_MAX_LIMIT = 500
+### POLL CONFIG ###
+
+### SEND CONFIG ###
+# Maximum number of messages in one request to /api/send.
+SEND_MAX_BATCH = 100
+# Maximum number of recipients of one message.
+SEND_MAX_RECIPIENTS = 1000
+### SEND CONFIG ###
+
+### MESSAGE CONFIG ###
+# How messages are stored: "hash" stores one field per attribute,
+# "struct" and "msgpack" pack a message into a single value.
+# Messages stored as hashes can be packed with `python migrate.py`.
+MESSAGE_SERIALIZER = "struct"
+# Compression of packed content: "zlib", "lz4" or None.
+MESSAGE_COMPRESSION = "zlib"
+# Content longer than this many bytes is compressed.
+MESSAGE_COMPRESS_THRESHOLD = 256
+# Seconds after which a message is deleted, even if it was not
+# recieved by all of its recipients. None keeps messages forever.
+MESSAGE_TTL = 30 * 24 * 60 * 60
+### MESSAGE CONFIG ###
+
+### USER CONFIG ###
+# Messages marked as recieved per round trip when a user is deleted.
+USER_DELETE_BATCH = 1000
+### USER CONFIG ###
+
+### CACHE CONFIG ###
+# Number of user profiles cached by every process. 0 disables the cache.
+USER_CACHE_SIZE = 10000
+# Seconds a cached profile is used for before it is read again.
+USER_CACHE_TTL = 60
+### CACHE CONFIG ###
+
+### ELECTION CONFIG ###
+# Seconds an election runs for, unless enough members vote before.
+ELECTION_DURATION = 2 * 60
+# Percentage of the members, other than the user the election is about,
+# who have to vote for the election to be concluded before it runs out.
+ELECTION_TURNOUT = 60
+# Percentage of the votes which have to be yes for an election to pass.
+ELECTION_MAJORITY = 50
+# Seconds between sweeps for elections which have run out, and number
+# of elections read per round trip by a sweep.
+ELECTION_SWEEP_INTERVAL = 1
+ELECTION_SWEEP_BATCH = 100
+### ELECTION CONFIG ###
+
+### ADMISSION CONFIG ###
+# Requests to these routes, named after their function in main.py, are
+# admitted by token buckets of the user and of the group they are made for.
+ADMISSION_ROUTES = (
+    "poll", "get_messages", "ack_messages",
+    "send", "send_user", "send_group"
+)
+# Every bucket holds up to "burst" tokens and is refilled with "rate"
+# tokens per second. A request takes a token from every bucket, or one per
+# message from /api/send, and is refused with 429 if any bucket runs out.
+# A rate of 0 disables the buckets of that kind. Buckets are stored with
+# their user or group, and are checked node by node starting with the node
+# of the user, so a request refused by it takes one round trip. Tokens
+# taken before a request is refused are given back.
+ADMISSION_LIMITS = {
+    "user": {"rate": 10, "burst": 50},
+    "group": {"rate": 20, "burst": 100},
+}
+### ADMISSION CONFIG ###
+
+### PRESENCE CONFIG ###
+# Seconds after their last poll a user is away. Users waiting in a poll
+# are only notified while online, so this must exceed POLL_MAX_WAIT.
+PRESENCE_AWAY = 60
+# Seconds after their last poll a user who is away is forgotten, and
+# is then offline as if they had never polled.
+PRESENCE_FORGET = 30 * 24 * 60 * 60
+# Seconds between sweeps moving users who are away out of the online
+# set, and most users moved and forgotten on every node by one sweep.
+PRESENCE_SWEEP_INTERVAL = 10
+PRESENCE_SWEEP_BATCH = 1000
+# Number of users listed by /api/presence/online and /api/presence/away
+# if the request does not set a limit, and the highest limit and offset
+# it may set. Every node is read up to the offset plus the limit.
+PRESENCE_DEFAULT_LIMIT = 50
+PRESENCE_MAX_LIMIT = 500
+PRESENCE_MAX_OFFSET = 10000
+### PRESENCE CONFIG ###
+
+### ID CONFIG ###
+# IDs hold the milliseconds since ID_EPOCH, so they are ordered by the
+# time they were allocated at. ID_EPOCH is in milliseconds since 1970.
+ID_EPOCH = 1388534400000 # 2014-01-01 00:00:00 UTC
+# Seconds a process leases its worker ID for. The lease is renewed every
+# half of this, and the worker ID is reused by another process once its
+# lease expires.
+ID_LEASE_TTL = 60
+### ID CONFIG ###
+
+### COMPACTOR CONFIG ###
+# Seconds between runs of the compactor in compactor.py.
+COMPACTOR_INTERVAL = 60 * 60
+# Keys scanned and list entries read per round trip.
+COMPACTOR_BATCH = 500
+# Seconds to wait after a run starts before scanning, so that messages
+# created before the run have been sent to all of their recipients, and
+# so that clocks of other processes which are behind have caught up.
+COMPACTOR_GRACE = 5
+### COMPACTOR CONFIG ###
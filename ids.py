@@ -0,0 +1,158 @@
+"""
+Copyright 2014 VoterChat
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import threading
+import time
+import uuid
+
+import config
+from main import r
+
+# An ID holds, from the highest bits down, the milliseconds since
+# `config.ID_EPOCH`, the worker which allocated it and a sequence number,
+# so IDs are ordered by the time they were allocated at.
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKERS = 1 << WORKER_BITS
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+# The keys of the generator share a hash tag, so they are on the same node.
+WORKER = "ids:{ids}:worker:%d" # Token of the process leasing a worker ID
+NEXT = "ids:{ids}:next" # Counter the next worker ID to try is taken from
+FLUSHED = "ids:{ids}:flushed" # Notified when the databases are flushed
+
+# Extends the lease KEYS[1] by ARGV[2] milliseconds if it is still held
+# by the token ARGV[1]. Returns 0 if the lease was lost.
+_renew = r.register_script("""
+if redis.call("GET", KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call("PEXPIRE", KEYS[1], ARGV[2])
+return 1
+""")
+
+def first_id(stamp):
+    """
+    Returns the lowest ID which can be allocated at a time
+    in milliseconds since the epoch. IDs lower than it
+    were allocated before that time.
+    """
+    return (stamp - config.ID_EPOCH) << (WORKER_BITS + SEQUENCE_BITS)
+
+def stamp(obj_id):
+    """
+    Returns the time an ID was allocated at,
+    in milliseconds since the epoch.
+    """
+    return (int(obj_id) >> (WORKER_BITS + SEQUENCE_BITS)) + config.ID_EPOCH
+
+class Generator(object):
+    """
+    Allocates IDs without a round trip to the database.
+
+    Every process leases a worker ID from the database and
+    allocates IDs from the clock, its worker ID and a sequence
+    number. The lease is renewed every half of `lease_ttl`, so
+    the database is only asked when the lease is renewed.
+
+    IDs of a process never go back in time. If the clock goes
+    back, or the sequence of a millisecond runs out, the process
+    keeps allocating from the following milliseconds.
+
+    Flushing the databases drops the leases of all processes,
+    so every process which leased a worker ID listens on the
+    channel of `FLUSHED` and checks its lease again before the
+    next ID is allocated, see `models.flushdb`.
+    """
+
+    def __init__(self, lease_ttl=None):
+        self.lease_ttl = lease_ttl or config.ID_LEASE_TTL
+        self.token = uuid.uuid4().hex
+        self.lock = threading.Lock()
+        self.worker = None
+        self.renew_at = 0
+        self.last = 0
+        self.sequence = 0
+        self.listening = False
+
+    def lease(self):
+        """
+        Leases a worker ID no other process is using.
+        """
+        ttl = self.lease_ttl * 1000
+        for _ in range(MAX_WORKERS):
+            worker = r.incr(NEXT) % MAX_WORKERS
+            if r.set(WORKER % worker, self.token, px=ttl, nx=True):
+                self.worker = worker
+                self.renew_at = time.time() + self.lease_ttl / 2.0
+                if not self.listening:
+                    # Imported here, as notify imports main, which
+                    # imports this module through the compactor.
+                    import notify
+                    self.listening = True
+                    notify.notifier.on(
+                        notify.channel(FLUSHED), self.revalidate
+                    )
+                return
+        raise RuntimeError("All %d worker IDs are leased." % MAX_WORKERS)
+
+    def renew(self):
+        """
+        Renews the lease of the worker ID, or leases
+        another one if the lease was lost.
+        """
+        if self.worker is not None:
+            key = WORKER % self.worker
+            if _renew(keys=[key], args=[self.token, self.lease_ttl * 1000]):
+                self.renew_at = time.time() + self.lease_ttl / 2.0
+                return
+        self.lease()
+
+    def revalidate(self, data=None):
+        """
+        Renews the lease before the next ID is allocated, which
+        leases another worker ID if the lease was flushed.
+        """
+        with self.lock:
+            self.renew_at = 0
+
+    def next(self, count=1):
+        """
+        Returns a list of `count` new IDs.
+        """
+        with self.lock:
+            if time.time() >= self.renew_at:
+                self.renew()
+
+            ids = []
+            for _ in range(count):
+                now = max(int(time.time() * 1000), self.last)
+                if now == self.last:
+                    self.sequence += 1
+                    if self.sequence > MAX_SEQUENCE:
+                        now += 1
+                        self.sequence = 0
+                else:
+                    self.sequence = 0
+                self.last = now
+                ids.append(
+                    first_id(now)
+                    | (self.worker << SEQUENCE_BITS)
+                    | self.sequence
+                )
+            return ids
+
+generator = Generator()
@@ -0,0 +1,141 @@
+"""
+Copyright 2014 VoterChat
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import atexit
+import json
+import logging
+import random
+import sys
+import threading
+import Queue
+from datetime import datetime
+
+import config
+
+class QueueHandler(logging.Handler):
+    """
+    Handler putting records on a queue, to be formatted and
+    written by a `QueueListener`. Records are dropped, and
+    counted, when the queue is full, so that logging never
+    blocks a request.
+    """
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.dropped = 0
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+class QueueListener(object):
+    """
+    Writes the records put on a queue with a handler,
+    in a thread of its own.
+    """
+
+    def __init__(self, queue, handler):
+        self.queue = queue
+        self.handler = handler
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            self.handler.handle(record)
+
+    def stop(self):
+        """
+        Writes the records left on the queue and stops the thread.
+        """
+        self.queue.put(None)
+        self.thread.join(5)
+
+class JSONFormatter(logging.Formatter):
+    """
+    Formats a record as a line of JSON holding its
+    time, level, event and fields.
+    """
+
+    def format(self, record):
+        stamp = datetime.utcfromtimestamp(record.created)
+        data = {
+            "time": stamp.isoformat() + "Z",
+            "level": record.levelname,
+            "event": record.getMessage()
+        }
+        data.update(getattr(record, "fields", {}))
+        return json.dumps(data, sort_keys=True)
+
+_queue = Queue.Queue(config.LOG_QUEUE_SIZE)
+handler = QueueHandler(_queue)
+logger = logging.getLogger("voterchat")
+logger.setLevel(logging.DEBUG)
+logger.addHandler(handler)
+logger.propagate = False
+listener = None
+
+def install():
+    """
+    Starts writing the logged records to `config.LOG_FILE`,
+    or to stderr if it is None.
+    """
+    global listener
+    if config.LOG_FILE:
+        writer = logging.FileHandler(config.LOG_FILE)
+    else:
+        writer = logging.StreamHandler(sys.stderr)
+    writer.setFormatter(JSONFormatter())
+    listener = QueueListener(_queue, writer)
+    listener.start()
+    atexit.register(listener.stop)
+
+def event(name, level="INFO", **fields):
+    """
+    Logs an event, such as a request to a route, with the
+    given fields. The level and the fraction of the events
+    which are logged are set per event in `config.LOG_ROUTES`.
+
+    Fields are written as they are, so they must only be IDs
+    and counts, never the content of messages.
+    """
+    settings = config.LOG_ROUTES.get(name, {})
+    threshold = settings.get("level", config.LOG_LEVEL)
+    if logging.getLevelName(level) < logging.getLevelName(threshold):
+        return
+    sample = settings.get("sample", config.LOG_SAMPLE_RATE)
+    if sample < 1 and random.random() >= sample:
+        return
+    if sample < 1:
+        fields["sample"] = sample
+    logger.log(logging.getLevelName(level), name, extra={"fields": fields})
+
+def stats():
+    """
+    Returns the number of records waiting to be
+    written and the number of dropped records.
+    """
+    return {"queued": _queue.qsize(), "dropped": handler.dropped}
@@ -18,15 +18,24 @@ limitations under the License.
 
 import config
 
-from flask import Flask, abort, jsonify, request
+from flask import (
+    Flask, Response, abort, jsonify, request, stream_with_context
+)
 app = Flask(__name__)
 app.config.from_object("config")
 
-import redis
-r = redis.StrictRedis(
-    host=config.REDIS_HOST,
-    port=config.REDIS_PORT,
-    db=config.REDIS_DB
+import logs
+logs.install()
+
+import metrics
+metrics.install(app)
+
+import shards
+r = shards.ShardedRedis(
+    config.REDIS_NODES,
+    max_connections=config.REDIS_MAX_CONNECTIONS,
+    timeout=config.REDIS_POOL_TIMEOUT,
+    connection_class=metrics.Connection
 )
 
 ### INITIALIZATION ###
@@ -34,20 +43,58 @@ r = redis.StrictRedis(
 
 ### APP FUNCTIONS ###
 
+import admission
+admission.install(app, r)
+
+import compactor
 import models
 
+# Streamed responses are encoded with the fastest encoder installed.
+try:
+    import ujson as json
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        import json
+
 # TODO: Require admin authentication.
 @app.route("/api/flushdb")
 def flushdb():
     """
-    Flush the database.
+    Flush the databases of all nodes.
     """
     r.flushdb()
     models.flushdb()
 
-    app.logger.info("[DB] Database has been flushed.")
+    logs.event("flushdb")
     return "", 200
 
+# TODO: Require admin authentication.
+@app.route("/api/stats")
+def stats():
+    """
+    Return the counters of the caches, the compactor, admission
+    control and the log queue.
+    """
+    return jsonify({
+        "user_cache": models.user_cache.stats(),
+        "compactor": compactor.stats(),
+        "admission": admission.stats(),
+        "logs": logs.stats()
+    }), 200
+
+# TODO: Require admin authentication.
+@app.route("/metrics")
+def get_metrics():
+    """
+    Return the Redis commands, round trips, bytes and time of
+    every endpoint and model method, in the Prometheus format.
+    """
+    return metrics.render(), 200, {
+        "Content-Type": "text/plain; version=0.0.4"
+    }
+
 @app.route("/api/user/<username>")
 def get_user(username):
     """
@@ -56,6 +103,55 @@ def get_user(username):
     user = models.User(username)
     return jsonify(user.get()), 200
 
+@app.route("/api/user/<username>/presence")
+def get_presence(username):
+    """
+    Return whether the user is online, away or offline, and
+    the time they last polled at in milliseconds since the epoch.
+    """
+    user = models.User(username)
+    status, seen = user.presence()
+    return jsonify({"status": status, "seen": seen}), 200
+
+@app.route("/api/presence/<status>")
+def get_presence_users(status):
+    """
+    Return a page of the users who are 'online' or 'away', with
+    the time they last polled at, most recent first. The page
+    holds up to 'limit' users after the first 'offset', and
+    'more' is true if there are more. If 'since' is given, only
+    the users away who polled at or after that time, in
+    milliseconds since the epoch.
+    """
+    if status not in ("online", "away"):
+        abort(404)
+    offset = request.args.get("offset", 0, type=int)
+    if not 0 <= offset <= config.PRESENCE_MAX_OFFSET:
+        return jsonify({
+            "message": "Field 'offset' must be from 0 to %d."
+                % config.PRESENCE_MAX_OFFSET
+        }), 400
+    limit = request.args.get(
+        "limit", config.PRESENCE_DEFAULT_LIMIT, type=int
+    )
+    if not 0 < limit <= config.PRESENCE_MAX_LIMIT:
+        return jsonify({
+            "message": "Field 'limit' must be from 1 to %d."
+                % config.PRESENCE_MAX_LIMIT
+        }), 400
+
+    if status == "online":
+        users, more = models.online_users(offset, limit)
+    else:
+        since = request.args.get("since", type=int)
+        users, more = models.away_users(since, offset, limit)
+    return jsonify({
+        "users": [
+            {"username": username, "seen": seen} for username, seen in users
+        ],
+        "more": more
+    }), 200
+
 @app.route("/api/user/<username>/new", methods=["POST"])
 def new_user(username):
     """
@@ -71,7 +167,7 @@ def new_user(username):
     )
     user.new()
 
-    app.logger.info("[USER] User %s was created." % username)
+    logs.event("new_user", user=username)
     return jsonify(user.get()), 201
 
 # TODO: Require either admin or user authentication.
@@ -83,7 +179,7 @@ def delete_user(username):
     user = models.User(username)
     user.delete()
 
-    app.logger.info("[USER] User %s has been deleted." % username)
+    logs.event("delete_user", user=username)
     return "", 200
 
 # TODO: Require user authentication.
@@ -106,22 +202,269 @@ def send_user(recipient):
     sender = models.User(request.form["username"])
     recipient = models.User(recipient)
 
-    msg = models.Message(
-        models.new_id("message"),
-        sender=sender.id,
-        content=request.form["content"]
+    msg = models.send_message(
+        sender.id,
+        request.form["content"],
+        recipients=[recipient.id]
     )
-    msg.new()
-    msg.send_users([recipient.id])
 
-    app.logger.info("[PM] %s -> %s" % (recipient.id, sender.id))
+    logs.event("send_user", sender=sender.id, recipient=recipient.id,
+               message=msg.id)
+    return "", 200
+
+# TODO: Require user authentication.
+@app.route("/api/send", methods=["POST"])
+def send():
+    """
+    Send a batch of messages. The body is a JSON object:
+
+        {
+            "username": "alice",
+            "messages": [
+                {"recipients": ["bob", "carol"], "content": "Hi!"},
+                {"group": "friends", "content": "Hey guys!"}
+            ]
+        }
+
+    Every message is stored once and sent either to a group or to
+    a list of recipients. Returns the ID of every message, or the
+    reason it could not be sent, in the order they were given.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        abort(400)
+    if not "username" in data:
+        return jsonify({
+            "message": "Field 'username' was not specified."
+        }), 400
+    if not isinstance(data["username"], basestring):
+        return jsonify({
+            "message": "Field 'username' must be a string."
+        }), 400
+    messages = data.get("messages")
+    if not isinstance(messages, list) or not messages:
+        return jsonify({
+            "message": "Field 'messages' must be a non-empty list."
+        }), 400
+    if len(messages) > config.SEND_MAX_BATCH:
+        return jsonify({
+            "message": "At most %d messages can be sent at once."
+                % config.SEND_MAX_BATCH
+        }), 400
+
+    sender = models.User(data["username"])
+    msg_ids = models.new_ids("message", len(messages))
+
+    results = []
+    for msg_id, message in zip(msg_ids, messages):
+        if not isinstance(message, dict) or not "content" in message:
+            results.append({"error": "Field 'content' was not specified."})
+            continue
+        if not isinstance(message["content"], basestring):
+            results.append({"error": "Field 'content' must be a string."})
+            continue
+        recipients = message.get("recipients") or []
+        if not isinstance(recipients, list) or not all(
+                isinstance(recipient, basestring) for recipient in recipients):
+            results.append({
+                "error": "Field 'recipients' must be a list of strings."
+            })
+            continue
+        if not isinstance(message.get("group") or "", basestring):
+            results.append({"error": "Field 'group' must be a string."})
+            continue
+        if not message.get("group") and not recipients:
+            results.append({
+                "error": "Either 'group' or 'recipients' must be specified."
+            })
+            continue
+        if len(recipients) > config.SEND_MAX_RECIPIENTS:
+            results.append({
+                "error": "At most %d recipients can be specified."
+                    % config.SEND_MAX_RECIPIENTS
+            })
+            continue
+
+        try:
+            models.send_message(
+                sender.id,
+                message["content"],
+                recipients=recipients,
+                group=message.get("group"),
+                msg_id=msg_id
+            )
+        except ValueError as e:
+            results.append({"error": str(e)})
+        else:
+            # IDs are strings, as they exceed the integers JSON clients
+            # can represent exactly.
+            results.append({"id": msg_id})
+
+    logs.event("send", sender=sender.id, messages=len(messages),
+               failed=sum(1 for result in results if "error" in result))
+    return jsonify({"messages": results}), 200
+
+# TODO: Require user authentication.
+@app.route("/api/group/<groupname>/new", methods=["POST"])
+def new_group(groupname):
+    """
+    Creates a new group with the user as its first member.
+    """
+    if not request.form:
+        abort(400)
+    if not "username" in request.form:
+        return jsonify({
+            "message": "Field 'username' was not specified."
+        }), 400
+
+    group = models.Group(groupname)
+    group.new(request.form["username"])
+
+    logs.event("new_group", group=groupname)
+    return "", 201
+
+# TODO: Require admin authentication.
+@app.route("/api/group/<groupname>/delete")
+def delete_group(groupname):
+    """
+    Delete a group, its running elections and its messages.
+    """
+    group = models.Group(groupname)
+    group.delete()
+
+    logs.event("delete_group", group=groupname)
+    return "", 200
+
+# TODO: Require user authentication.
+@app.route("/api/group/<groupname>/leave", methods=["POST"])
+def leave_group(groupname):
+    """
+    Remove a user from a group.
+    """
+    if not request.form:
+        abort(400)
+    if not "username" in request.form:
+        return jsonify({
+            "message": "Field 'username' was not specified."
+        }), 400
+
+    group = models.Group(groupname)
+    group.leave(request.form["username"])
+
+    logs.event("leave_group", user=request.form["username"], group=groupname)
     return "", 200
 
+# TODO: Require user authentication.
+@app.route("/api/group/<groupname>/send", methods=["POST"])
+def send_group(groupname):
+    """
+    Send a message to a group.
+    """
+    if not request.form:
+        abort(400)
+    if not "username" in request.form:
+        return jsonify({
+            "message": "Field 'username' was not specified."
+        }), 400
+    if not "content" in request.form:
+        return jsonify({
+            "message": "Field 'content' was not specified."
+        }), 400
+
+    sender = models.User(request.form["username"])
+    group = models.Group(groupname)
+
+    msg = models.send_message(
+        sender.id, request.form["content"], group=group.id
+    )
+
+    logs.event("send_group", sender=sender.id, group=group.id, message=msg.id)
+    return "", 200
+
+# TODO: Require user authentication.
+@app.route("/api/group/<groupname>/elections")
+def group_elections(groupname):
+    """
+    Return the elections running in a group.
+    """
+    group = models.Group(groupname)
+    return jsonify({"elections": group.elections()}), 200
+
+# TODO: Require user authentication.
+@app.route("/api/group/<groupname>/invite", methods=["POST"],
+           defaults={"kind": "invite"})
+@app.route("/api/group/<groupname>/kick", methods=["POST"],
+           defaults={"kind": "kick"})
+def start_election(groupname, kind):
+    """
+    Start an election to invite a user to a group or to kick
+    a user from it. Users may ask to be invited themselves.
+    """
+    if not request.form:
+        abort(400)
+    for field in ("username", "candidate"):
+        if not field in request.form:
+            return jsonify({
+                "message": "Field '%s' was not specified." % field
+            }), 400
+
+    election = models.Election(groupname, request.form["candidate"])
+    try:
+        deadline = election.start(kind, request.form["username"])
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+
+    logs.event("start_election", group=groupname, kind=kind,
+               user=request.form["username"],
+               candidate=request.form["candidate"])
+    return jsonify({"deadline": deadline}), 201
+
+# TODO: Require user authentication.
+@app.route("/api/group/<groupname>/vote", methods=["POST"])
+def vote(groupname):
+    """
+    Vote in an election of a group. 'vote' is either "yes" or "no".
+    Returns "counted", or the verdict if the vote concluded it.
+    """
+    if not request.form:
+        abort(400)
+    for field in ("username", "candidate", "vote"):
+        if not field in request.form:
+            return jsonify({
+                "message": "Field '%s' was not specified." % field
+            }), 400
+    if request.form["vote"] not in ("yes", "no"):
+        return jsonify({
+            "message": "Field 'vote' must be 'yes' or 'no'."
+        }), 400
+
+    election = models.Election(groupname, request.form["candidate"])
+    try:
+        result = election.vote(
+            request.form["username"], request.form["vote"] == "yes"
+        )
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+
+    logs.event("vote", group=groupname, user=request.form["username"],
+               result=result)
+    return jsonify({"result": result}), 200
+
 # TODO: Require user authentication.
 @app.route("/api/poll", methods=["POST"])
 def poll():
     """
     Poll the server for new messages.
+
+    If 'wait' is given, the request is held for up to that
+    many seconds until a message arrives. Waiting requests
+    should be served by a gevent worker, see the README.
+
+    If 'stream' is 1, messages are streamed as newline delimited
+    JSON while they are popped, so that the first ones are sent
+    at once and the response is never held in memory. Messages
+    already popped are lost if the client disconnects, clients
+    which cannot afford that should read and acknowledge them.
     """
     if not request.form:
         abort(400)
@@ -130,12 +473,101 @@ def poll():
             "message": "Field 'username' was not specified."
         }, 400
 
+    limit = request.form.get("limit", type=int)
+    if limit is not None and limit < 1:
+        return jsonify({
+            "message": "Field 'limit' must be a positive integer."
+        }), 400
+
+    wait = request.values.get("wait", 0, type=int)
+    if wait < 0:
+        return jsonify({
+            "message": "Field 'wait' must not be negative."
+        }), 400
+
     user = models.User(request.form["username"])
-    msg_list = user.poll()
+    wait = min(wait, config.POLL_MAX_WAIT)
+    if request.form.get("stream", 0, type=int):
+        messages = user.stream(limit, wait)
+        # Pop the first message before responding, so that
+        # errors are not raised after the status is sent.
+        first = next(messages, None)
+
+        def encode():
+            count = 0
+            if first is not None:
+                count += 1
+                yield json.dumps(first) + "\n"
+            for data in messages:
+                count += 1
+                yield json.dumps(data) + "\n"
+            logs.event("poll", user=user.id, messages=count)
+        return Response(
+            stream_with_context(encode()), mimetype="application/x-ndjson"
+        )
+
+    msg_list = user.poll(limit, wait)
 
-    app.logger.info(msg_list)
+    logs.event("poll", user=user.id, messages=len(msg_list))
     return jsonify({"messages": msg_list}), 200
 
+# TODO: Require user authentication.
+@app.route("/api/user/<username>/messages")
+def get_messages(username):
+    """
+    Read messages from the user's queue without removing them.
+
+    Messages are read after the message whose ID is given as
+    'after', or from the first message not acknowledged yet, up
+    to 'limit' at a time. The response holds the cursor to read
+    the following messages from as 'next', and 'more' is true if
+    there are any. Messages stay in the queue until they are
+    acknowledged, so a request which failed can be retried.
+    """
+    limit = request.args.get("limit", config.READ_DEFAULT_LIMIT, type=int)
+    if not 0 < limit <= config.READ_MAX_LIMIT:
+        return jsonify({
+            "message": "Field 'limit' must be from 1 to %d."
+                % config.READ_MAX_LIMIT
+        }), 400
+
+    after = request.args.get("after")
+    if after is not None and not after.isdigit():
+        return jsonify({
+            "message": "Field 'after' must be a message ID."
+        }), 400
+
+    user = models.User(username)
+    msg_list, more, cursor = user.read(after, limit)
+
+    logs.event("get_messages", user=user.id, messages=len(msg_list))
+    return jsonify({"messages": msg_list, "more": more, "next": cursor}), 200
+
+# TODO: Require user authentication.
+@app.route("/api/user/<username>/ack", methods=["POST"])
+def ack_messages(username):
+    """
+    Acknowledge the messages read from the user's queue up to and
+    including the message whose ID is given as 'until', removing
+    them from the queue. Acknowledging them again does nothing.
+    """
+    if not request.form:
+        abort(400)
+    if not "until" in request.form:
+        return jsonify({
+            "message": "Field 'until' was not specified."
+        }), 400
+    if not request.form["until"].isdigit():
+        return jsonify({
+            "message": "Field 'until' must be a message ID."
+        }), 400
+
+    user = models.User(username)
+    count = user.ack(request.form["until"])
+
+    logs.event("ack_messages", user=user.id, messages=count)
+    return jsonify({"acknowledged": count}), 200
+
 ### APP FUNCTIONS ###
 
 if __name__ == "__main__":
@@ -0,0 +1,247 @@
+"""
+Copyright 2014 VoterChat
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import cProfile
+import functools
+import inspect
+import pstats
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+from StringIO import StringIO
+
+import redis
+
+import config
+import logs
+
+# Counters kept for every scope, with the names and descriptions
+# of the metrics they are exported as.
+METRICS = (
+    ("calls", "calls_total", "Times the scope was entered."),
+    ("seconds", "seconds_total", "Seconds spent in the scope."),
+    ("commands", "redis_commands_total", "Redis commands sent."),
+    ("round_trips", "redis_round_trips_total", "Round trips to Redis."),
+    ("bytes_sent", "redis_bytes_sent_total", "Bytes sent to Redis."),
+    ("bytes_received", "redis_bytes_received_total",
+     "Bytes received from Redis."),
+    ("redis_seconds", "redis_seconds_total",
+     "Seconds spent waiting on Redis."),
+)
+PREFIX = "voterchat_"
+
+_local = threading.local()
+_lock = threading.Lock()
+# Mapping from (kind, name) -> counters of all finished scopes
+_totals = defaultdict(Counter)
+
+def _record(**counts):
+    """
+    Adds to the counters of every scope the current request is in.
+    Commands sent outside of a scope, such as by the notifier, are
+    not recorded.
+    """
+    for scope in getattr(_local, "scopes", ()):
+        scope.counts.update(counts)
+
+class Scope(object):
+    """
+    Part of a request, such as the request itself or a model method,
+    whose Redis commands are counted. Scopes nest, and commands are
+    counted in every scope they were sent in.
+    """
+
+    def __init__(self, kind, name):
+        self.kind = kind
+        self.name = name
+        self.counts = Counter()
+        self.start = time.time()
+
+def start(kind, name):
+    """
+    Enters a scope and returns it.
+    """
+    scope = Scope(kind, name)
+    if not hasattr(_local, "scopes"):
+        _local.scopes = []
+    _local.scopes.append(scope)
+    return scope
+
+def finish(scope):
+    """
+    Leaves a scope and adds its counters to the totals. The scope
+    may already be gone if a generator is closed in another thread.
+    """
+    scopes = getattr(_local, "scopes", [])
+    if scope in scopes:
+        scopes.remove(scope)
+    scope.counts["calls"] += 1
+    scope.counts["seconds"] += time.time() - scope.start
+    with _lock:
+        _totals[(scope.kind, scope.name)].update(scope.counts)
+
+def instrument(cls):
+    """
+    Class decorator counting the Redis commands of every public
+    method of the class, in a "model" scope named after the
+    class and method, such as "User.poll". The scope of a
+    generator lasts until it is exhausted or closed.
+    """
+    def wrap(method, name):
+        if inspect.isgeneratorfunction(method):
+            @functools.wraps(method)
+            def generator(*args, **kwargs):
+                scope = start("model", name)
+                try:
+                    for item in method(*args, **kwargs):
+                        yield item
+                finally:
+                    finish(scope)
+            return generator
+
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            scope = start("model", name)
+            try:
+                return method(*args, **kwargs)
+            finally:
+                finish(scope)
+        return wrapper
+
+    for name, method in vars(cls).items():
+        if not name.startswith("_") and callable(method):
+            setattr(cls, name, wrap(method, "%s.%s" % (cls.__name__, name)))
+    return cls
+
+class Connection(redis.Connection):
+    """
+    Connection to Redis counting the commands, round trips,
+    bytes and time of every scope it is used in.
+    """
+
+    def _connect(self):
+        return _CountingSocket(redis.Connection._connect(self))
+
+    def pack_command(self, *args):
+        _record(commands=1)
+        return redis.Connection.pack_command(self, *args)
+
+    def send_packed_command(self, command):
+        start = time.time()
+        chunks = command if isinstance(command, list) else [command]
+        try:
+            return redis.Connection.send_packed_command(self, command)
+        finally:
+            _record(
+                round_trips=1,
+                bytes_sent=sum(len(chunk) for chunk in chunks),
+                redis_seconds=time.time() - start
+            )
+
+    def read_response(self):
+        start = time.time()
+        try:
+            return redis.Connection.read_response(self)
+        finally:
+            _record(redis_seconds=time.time() - start)
+
+class _CountingSocket(object):
+    """
+    Socket counting the bytes recieved on it.
+    """
+
+    def __init__(self, sock):
+        self._sock = sock
+
+    def recv(self, *args):
+        data = self._sock.recv(*args)
+        _record(bytes_received=len(data))
+        return data
+
+    def recv_into(self, *args):
+        size = self._sock.recv_into(*args)
+        _record(bytes_received=size)
+        return size
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+def render():
+    """
+    Returns the totals of all scopes in the Prometheus text format.
+    Every process keeps its own totals.
+    """
+    with _lock:
+        totals = dict(
+            (key, Counter(counts)) for key, counts in _totals.iteritems()
+        )
+
+    lines = []
+    for counter, metric, description in METRICS:
+        lines.append("# HELP %s%s %s" % (PREFIX, metric, description))
+        lines.append("# TYPE %s%s counter" % (PREFIX, metric))
+        for (kind, name), counts in sorted(totals.items()):
+            lines.append('%s%s{kind="%s",name="%s"} %r' % (
+                PREFIX, metric, kind, name, counts[counter]
+            ))
+    return "\n".join(lines) + "\n"
+
+def install(app):
+    """
+    Counts the Redis commands of every request to the app in a
+    "route" scope named after its endpoint, logs requests slower
+    than `config.SLOW_REQUEST_SECONDS` and profiles a sample
+    of `config.PROFILE_SAMPLE_RATE` of the requests.
+    """
+    from flask import g, request
+
+    @app.before_request
+    def start_request():
+        g.metrics_scope = start("route", request.endpoint or "unknown")
+        if random.random() < config.PROFILE_SAMPLE_RATE:
+            g.profile = cProfile.Profile()
+            g.profile.enable()
+
+    @app.teardown_request
+    def finish_request(exc=None):
+        scope = getattr(g, "metrics_scope", None)
+        if scope is None:
+            return
+        finish(scope)
+
+        profile = getattr(g, "profile", None)
+        if profile is not None:
+            profile.disable()
+            out = StringIO()
+            stats = pstats.Stats(profile, stream=out)
+            stats.sort_stats("cumulative").print_stats(config.PROFILE_TOP)
+            logs.event("profile", route=request.endpoint, path=request.path,
+                       stats=out.getvalue())
+
+        seconds = scope.counts["seconds"]
+        if seconds >= config.SLOW_REQUEST_SECONDS:
+            logs.event(
+                "slow_request",
+                level="WARNING",
+                route=scope.name,
+                seconds=round(seconds, 3),
+                commands=scope.counts["commands"],
+                round_trips=scope.counts["round_trips"],
+                bytes_sent=scope.counts["bytes_sent"],
+                bytes_received=scope.counts["bytes_received"],
+                redis_seconds=round(scope.counts["redis_seconds"], 3)
+            )
@@ -0,0 +1,29 @@
+"""
+Copyright 2014 VoterChat
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+# Renames the keys of objects stored before keys had hash tags and moves
+# them to the nodes they are routed to, and converts the queues of users
+# stored as lists into sorted sets, which have to be done while the servers
+# are stopped. Then packs messages stored as hashes with the serializer set
+# in config.py. Messages can be read in either form, so only the first two
+# steps have to be done before serving.
+
+import models
+
+if __name__ == "__main__":
+    print "Migrated %d key(s)." % models.migrate_keys()
+    print "Migrated %d queue(s)." % models.migrate_queues()
+    print "Migrated %d message(s)." % models.migrate_messages()
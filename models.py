@@ -14,89 +14,764 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
-from datetime import datetime
-from functools import wraps
+import json
+import re
+import time
+import uuid
 
+import cache
+import config
+import ids
+import metrics
+import notify
+import serializers
+import shards
 from main import r
 
+serializer = serializers.get_serializer(
+    config.MESSAGE_SERIALIZER,
+    config.MESSAGE_COMPRESSION,
+    config.MESSAGE_COMPRESS_THRESHOLD
+)
+
+# Sender of the notes sent to users by the server.
+SYSTEM = "system"
+
+# Profiles of users, keyed by the key of the user.
+user_cache = cache.Cache("user", config.USER_CACHE_SIZE, config.USER_CACHE_TTL)
+
 def flushdb():
     """
-    Prepare the database to store users.
+    Prepare the databases of all nodes to store users.
     """
-    r.set("message_last_id", 0)    
+    # The leases of the worker IDs of all processes were flushed.
+    ids.generator.revalidate()
+    r.publish(notify.channel(ids.FLUSHED), "")
 
-def exists(f):
+def does_not_exist(key):
     """
-    Raises an exception if the user does not exist.
+    Returns the exception raised when an object does not exist.
+
+    Methods check existence as part of their own database
+    operation instead of asking the database beforehand.
     """
-    @wraps(f)
-    def wrapper(self, *args, **kwargs):
-        if not r.exists(self.key):
-            raise ValueError(
-                "Object %s does not exist in the database." % self.key
-            )
-        return f(self, *args, **kwargs)
-    return wrapper
+    return ValueError("Object %s does not exist in the database." % key)
 
-def not_exists(f):
+def timestamp():
     """
-    Raises an exception if the user exists.
+    Returns the current time in milliseconds since the epoch.
     """
-    @wraps(f)
-    def wrapper(self, *args, **kwargs):
-        if r.exists(self.key):
-            raise ValueError(
-                "Object %s already exists in the database." % self.key
-            )
-        return f(self, *args, **kwargs)
-    return wrapper
+    return int(time.time() * 1000)
 
 def new_id(obj_type):
-    return r.incr("%s_last_id" % obj_type)
+    """
+    Returns a new ID for an object of the given type.
+    """
+    return new_ids(obj_type, 1)[0]
+
+def new_ids(obj_type, count):
+    """
+    Returns a list of `count` new IDs for objects of the given type.
+
+    IDs are allocated by `ids.generator` without a round trip
+    to the database, are unique across all types and are
+    ordered by the time they were allocated at. They are
+    returned as strings, as they are read from the database.
+    """
+    return [str(obj_id) for obj_id in ids.generator.next(count)]
+
+# Creates an object unless it already exists. KEYS[1] is the key of the
+# object, ARGV[1] the seconds it expires after, or 0 if it never expires,
+# and the rest of ARGV are its fields and values. Returns 0 if it exists.
+_new = r.register_script("""
+if redis.call("EXISTS", KEYS[1]) == 1 then
+    return 0
+end
+redis.call("HMSET", KEYS[1], unpack(ARGV, 2))
+if tonumber(ARGV[1]) > 0 then
+    redis.call("EXPIRE", KEYS[1], ARGV[1])
+end
+return 1
+""")
+
+# Reads messages stored either packed or as hashes. The first ARGV[1] KEYS
+# are the keys of the messages to read, the rest are keys of messages to
+# delete once they have been read. Returns the packed value or the hash
+# fields of every message, or false for missing messages.
+_read_messages = r.register_script("""
+local result = {}
+for i = 1, tonumber(ARGV[1]) do
+    local kind = redis.call("TYPE", KEYS[i])["ok"]
+    if kind == "string" then
+        result[i] = redis.call("GET", KEYS[i])
+    elseif kind == "hash" then
+        result[i] = redis.call("HGETALL", KEYS[i])
+    else
+        result[i] = false
+    end
+end
+for i = tonumber(ARGV[1]) + 1, #KEYS do
+    redis.call("DEL", KEYS[i])
+end
+return result
+""")
+
+# Replaces a message stored as a hash with its packed value ARGV[1].
+# KEYS[1] is the key of the message. Returns 0 if it is not a hash.
+_migrate = r.register_script("""
+if redis.call("TYPE", KEYS[1])["ok"] ~= "hash" then
+    return 0
+end
+local ttl = redis.call("PTTL", KEYS[1])
+redis.call("DEL", KEYS[1])
+redis.call("SET", KEYS[1], ARGV[1])
+if ttl > 0 then
+    redis.call("PEXPIRE", KEYS[1], ttl)
+end
+return 1
+""")
+
+def read_messages(msg_ids, delete=()):
+    """
+    Returns the fields of the messages given their IDs,
+    or None for every message which does not exist.
+
+    Parameters:
+    * delete - IDs of messages to delete after reading.
+
+    Messages are read in one round trip to every node
+    they are stored on.
+    """
+    keys = [Message(msg_id).key for msg_id in msg_ids]
+    items = [(key, True) for key in keys]
+    items.extend((Message(msg_id).key, False) for msg_id in delete)
+    values = {}
+    for client, node_items in r.partition(items, key=lambda item: item[0]):
+        read = [key for key, is_read in node_items if is_read]
+        deleted = [key for key, is_read in node_items if not is_read]
+        result = _read_messages(
+            keys=read + deleted, args=[len(read)], client=client
+        )
+        values.update(zip(read, result))
+
+    msg_lst = []
+    for value in (values.get(key) for key in keys):
+        if value is None:
+            msg_lst.append(None)
+        elif isinstance(value, list):
+            msg_lst.append(
+                serializers.loads_hash(dict(zip(value[::2], value[1::2])))
+            )
+        else:
+            msg_lst.append(serializers.loads(value))
+    return msg_lst
+
+def migrate_messages(count=1000):
+    """
+    Packs the messages stored as hashes using the configured
+    serializer. The keyspace is scanned `count` keys at a time,
+    so the database is not blocked while migrating.
+
+    Returns the number of migrated messages.
+    """
+    if not serializer.packed:
+        return 0
+
+    migrated = 0
+    for client in r.nodes():
+        for key in client.scan_iter("message:*", count=count):
+            if key.endswith(":count"):
+                continue
+            fields = None
+            if client.type(key) == "hash":
+                fields = client.hgetall(key)
+            if fields:
+                fields.setdefault("group", "")
+                fields["stamp"] = serializers.parse_stamp(fields["stamp"])
+                migrated += _migrate(
+                    keys=[key], args=[serializer.dumps(fields)], client=client
+                )
+    return migrated
+
+# Matches the keys of objects stored before keys had hash tags, as in
+# user:alice:queue, capturing the type and ID of the object and the rest
+# of the key.
+_UNTAGGED = re.compile(
+    r"^(user|group|message):([^{}]+?)"
+    r"(:queue(?::deleted:[0-9a-f]+)?|:groups|:offset|:ids|:count)?$"
+)
+
+def migrate_keys(count=1000):
+    """
+    Renames the keys of objects stored before keys had hash
+    tags, as in user:alice:queue, to user:{alice}:queue, moving
+    them to the node they are routed to. The keyspace is
+    scanned `count` keys at a time. Keys whose new name is
+    already taken are left as they are. Objects are looked up
+    by their new keys, so this has to run before the servers
+    are started again.
+
+    Returns the number of migrated keys.
+    """
+    migrated = 0
+    for client in r.nodes():
+        for pattern in ("user:*", "group:*", "message:*"):
+            for key in client.scan_iter(pattern, count=count):
+                match = _UNTAGGED.match(key)
+                if not match:
+                    continue
+                kind, obj_id, rest = match.groups()
+                new_key = "%s:{%s}%s" % (kind, obj_id, rest or "")
+                node = r.node(new_key)
+                if node is client:
+                    migrated += client.renamenx(key, new_key)
+                    continue
+
+                pipe = client.pipeline()
+                pipe.dump(key)
+                pipe.pttl(key)
+                data, ttl = pipe.execute()
+                if data is None or node.exists(new_key):
+                    continue
+                node.restore(new_key, max(ttl, 0), data)
+                client.delete(key)
+                migrated += 1
+    return migrated
+
+def migrate_queues(count=1000):
+    """
+    Converts the queues of users stored as lists into sorted
+    sets, see `User.read`. The keyspace is scanned `count` keys
+    at a time. Queues are pushed to as sorted sets, so this has
+    to run before the servers are started again.
+
+    Returns the number of migrated queues.
+    """
+    migrated = 0
+    for client in r.nodes():
+        for key in client.scan_iter("user:*:queue*", count=count):
+            if client.type(key) != "list":
+                continue
+            pipe = client.pipeline()
+            pipe.delete(key)
+            for msg_id in client.lrange(key, 0, -1):
+                pipe.zadd(key, ids.stamp(msg_id), msg_id)
+            pipe.execute()
+            migrated += 1
+    return migrated
+
+# Keys of the users stored on a node who are online and away, scored by
+# the time they last polled at in milliseconds since the epoch. Like
+# `DEADLINES`, they exist on every node and are not routed by the ring.
+# Every poll adds the user to `ONLINE`, and `sweep_presence` moves the
+# users who have not polled for `config.PRESENCE_AWAY` seconds to `AWAY`.
+ONLINE = "presence:online"
+AWAY = "presence:away"
+
+# Shared by the scripts queueing messages for users. Publishes a message ID
+# on the channel of the user `key` only if the user polled at or after
+# `cutoff`, the only users who may be waiting for it, so that messages to
+# dormant users are not sent to the notifier of every process.
+_NOTIFY = """
+local function notify(online, key, msg_id, cutoff)
+    local seen = redis.call("ZSCORE", online, key)
+    if seen and tonumber(seen) >= tonumber(cutoff) then
+        redis.call("PUBLISH", "notify:" .. key, msg_id)
+    end
+end
+"""
+
+# Pushes a message ID into the queue of every recipient in one round trip.
+# KEYS are (user:{<id>}, user:{<id>}:queue) pairs followed by
+# message:{<id>}, message:{<id>}:count and `ONLINE`, ARGV[1] is the message
+# ID, ARGV[2] the time users who polled before are away and ARGV[3] the
+# score of the message in the queues, see `User.read`. Nothing is
+# pushed if the message or any recipient is missing, in which case the keys
+# of the missing objects are returned. Online recipients are notified on
+# the channel "notify:user:{<id>}". The counter expires with the message.
+# All of the keys have to be stored on the same node.
+_send_users = r.register_script(_NOTIFY + """
+local missing = {}
+for i = 1, #KEYS - 2, 2 do
+    if redis.call("EXISTS", KEYS[i]) == 0 then
+        table.insert(missing, KEYS[i])
+    end
+end
+if #missing > 0 then
+    return missing
+end
+for i = 2, #KEYS - 3, 2 do
+    redis.call("ZADD", KEYS[i], ARGV[3], ARGV[1])
+    notify(KEYS[#KEYS], KEYS[i - 1], ARGV[1], ARGV[2])
+end
+redis.call("SET", KEYS[#KEYS - 1], (#KEYS - 3) / 2)
+local ttl = redis.call("PTTL", KEYS[#KEYS - 2])
+if ttl > 0 then
+    redis.call("PEXPIRE", KEYS[#KEYS - 1], ttl)
+end
+return missing
+""")
+
+# Sets the counter of a message to ARGV[1] recipients, before the message
+# is pushed to queues stored on other nodes. KEYS are message:{<id>} and
+# message:{<id>}:count. The counter expires with the message. Returns 0 if
+# the message does not exist.
+_reserve = r.register_script("""
+local ttl = redis.call("PTTL", KEYS[1])
+if ttl == -2 then
+    return 0
+end
+redis.call("SET", KEYS[2], ARGV[1])
+if ttl > 0 then
+    redis.call("PEXPIRE", KEYS[2], ttl)
+end
+return 1
+""")
+
+# Pushes a message ID into the queues of recipients stored on one node.
+# KEYS are (user:{<id>}, user:{<id>}:queue) pairs followed by `ONLINE`,
+# ARGV[1] to ARGV[3] are the same as for `_send_users`. Recipients which
+# do not exist are skipped. Returns their keys.
+_push = r.register_script(_NOTIFY + """
+local missing = {}
+for i = 1, #KEYS - 1, 2 do
+    if redis.call("EXISTS", KEYS[i]) == 1 then
+        redis.call("ZADD", KEYS[i + 1], ARGV[3], ARGV[1])
+        notify(KEYS[#KEYS], KEYS[i], ARGV[1], ARGV[2])
+    else
+        table.insert(missing, KEYS[i])
+    end
+end
+return missing
+""")
+
+# Pushes a message ID into the queue of a single user. KEYS are user:{<id>},
+# user:{<id>}:queue and `ONLINE` and ARGV is the same as for `_send_users`.
+# Returns 0 if the user does not exist.
+_send = r.register_script(_NOTIFY + """
+if redis.call("EXISTS", KEYS[1]) == 0 then
+    return 0
+end
+redis.call("ZADD", KEYS[2], ARGV[3], ARGV[1])
+notify(KEYS[3], KEYS[1], ARGV[1], ARGV[2])
+return 1
+""")
+
+# Marks a batch of messages as recieved by one user. KEYS are
+# (message:{<id>}, message:{<id>}:count) pairs. Messages which have
+# been recieved by all of their recipients are deleted.
+# Returns the number of messages which existed.
+_recieved = r.register_script("""
+local found = 0
+for i = 1, #KEYS, 2 do
+    found = found + redis.call("EXISTS", KEYS[i])
+    if redis.call("DECR", KEYS[i + 1]) <= 0 then
+        redis.call("DEL", KEYS[i], KEYS[i + 1])
+    end
+end
+return found
+""")
+
+# Deletes a user and moves their queue aside, so that it can be drained in
+# batches by `drain_queue` without blocking the database. KEYS are
+# user:{<id>}, user:{<id>}:queue, the key the queue is moved to, `ONLINE`
+# and `AWAY`. Returns false if the user does not exist.
+_delete_user = r.register_script("""
+if redis.call("DEL", KEYS[1]) == 0 then
+    return false
+end
+redis.call("ZREM", KEYS[4], KEYS[1])
+redis.call("ZREM", KEYS[5], KEYS[1])
+if redis.call("EXISTS", KEYS[2]) == 1 then
+    redis.call("RENAME", KEYS[2], KEYS[3])
+end
+return true
+""")
+
+def recieve_messages(msg_ids):
+    """
+    Marks messages as recieved by one user given their IDs, in
+    one round trip to every node the messages are stored on.
+    Returns the number of messages which existed.
+    """
+    found = 0
+    keys = [Message(msg_id).key for msg_id in msg_ids]
+    for client, node_keys in r.partition(keys):
+        pairs = []
+        for key in node_keys:
+            pairs.extend((key, "%s:count" % key))
+        found += _recieved(keys=pairs, client=client)
+    return found
 
+def drain_queue(key):
+    """
+    Empties a queue of a deleted user, marking every message in
+    it as recieved. Messages are drained `config.USER_DELETE_BATCH`
+    at a time, so a large queue does not block the database.
 
+    Every batch is popped before its messages are marked as
+    recieved on their own nodes, so the counters of a batch
+    popped by an interrupted drain are lowered by the compactor.
+    """
+    size = config.USER_DELETE_BATCH
+    while True:
+        pipe = r.pipeline(key)
+        pipe.zrange(key, 0, size - 1)
+        pipe.zremrangebyrank(key, 0, size - 1)
+        msg_ids, _ = pipe.execute()
+        recieve_messages(msg_ids)
+        if len(msg_ids) < size:
+            break
+
+# Shared by the queue scripts below. Returns whether the message ID `a`
+# is lower than `b`. IDs do not fit in Lua numbers, so they are compared
+# as decimal strings.
+_QUEUE_LOWER = """
+local function lower(a, b)
+    return #a < #b or (#a == #b and a < b)
+end
+"""
+
+# Reads up to ARGV[3] message IDs from a user's queue without popping them,
+# starting after the message ID ARGV[1] whether or not it is still in the
+# queue, or at the front of the queue if ARGV[1] is empty. ARGV[2] is the
+# score of ARGV[1]. KEYS are user:{<id>} and user:{<id>}:queue. Returns
+# one more ID than asked for if there is one, or false if the user does
+# not exist.
+_read_queue = r.register_script(_QUEUE_LOWER + """
+if redis.call("EXISTS", KEYS[1]) == 0 then
+    return false
+end
+local limit = tonumber(ARGV[3]) + 1
+if ARGV[1] == "" then
+    return redis.call("ZRANGE", KEYS[2], 0, limit - 1)
+end
+local msg_ids = {}
+for _, msg_id in ipairs(
+    redis.call("ZRANGEBYSCORE", KEYS[2], ARGV[2], ARGV[2])
+) do
+    if #msg_ids == limit then
+        return msg_ids
+    end
+    if lower(ARGV[1], msg_id) then
+        table.insert(msg_ids, msg_id)
+    end
+end
+for _, msg_id in ipairs(redis.call(
+    "ZRANGEBYSCORE", KEYS[2], "(" .. ARGV[2], "+inf",
+    "LIMIT", 0, limit - #msg_ids
+)) do
+    table.insert(msg_ids, msg_id)
+end
+return msg_ids
+""")
+
+# Pops up to ARGV[2] message IDs up to and including ARGV[1] from the front
+# of a user's queue. KEYS are the same as for `_read_queue`. Returns the
+# popped IDs, or false if the user does not exist.
+_ack_queue = r.register_script(_QUEUE_LOWER + """
+if redis.call("EXISTS", KEYS[1]) == 0 then
+    return false
+end
+local msg_ids = {}
+for _, msg_id in ipairs(
+    redis.call("ZRANGE", KEYS[2], 0, tonumber(ARGV[2]) - 1)
+) do
+    if lower(ARGV[1], msg_id) then
+        break
+    end
+    table.insert(msg_ids, msg_id)
+end
+if #msg_ids > 0 then
+    redis.call("ZREMRANGEBYRANK", KEYS[2], 0, #msg_ids - 1)
+end
+return msg_ids
+""")
+
+# Shared by the group scripts below. Trims the messages which have been
+# read by every member of a group from the front of the group's queue.
+# `offset` is the position of the first message still in the queue and
+# `ids` maps every member to the position of the next message they read,
+# as described in docs/Queue.txt. Returns the IDs of the trimmed messages.
+_GROUP_FLUSH = """
+local function flush(queue, offset, ids)
+    local start = tonumber(redis.call("GET", offset) or 0)
+    local low = redis.call("ZRANGE", ids, 0, 0, "WITHSCORES")
+    local mark
+    if #low == 0 then
+        mark = start + redis.call("LLEN", queue)
+    else
+        mark = tonumber(low[2])
+    end
+    if mark <= start then
+        return {}
+    end
+    local trimmed = redis.call("LRANGE", queue, 0, mark - start - 1)
+    redis.call("LTRIM", queue, mark - start, -1)
+    redis.call("SET", offset, mark)
+    return trimmed
+end
+"""
+
+# Adds a user to a group, starting them at the end of the group's queue.
+# KEYS are group:{<id>}:queue, group:{<id>}:offset, group:{<id>}:ids and
+# group:{<id>}, ARGV[1] is the username. Returns 0 if the group does not exist.
+_group_join = r.register_script("""
+if redis.call("EXISTS", KEYS[4]) == 0 then
+    return 0
+end
+local tail = tonumber(redis.call("GET", KEYS[2]) or 0)
+    + redis.call("LLEN", KEYS[1])
+redis.call("ZADD", KEYS[3], "NX", tail, ARGV[1])
+return 1
+""")
+
+# Removes a user from a group and flushes the group's queue. KEYS are
+# group:{<id>}:queue, group:{<id>}:offset and group:{<id>}:ids, ARGV[1] is the
+# username. Returns the IDs of the trimmed messages, or false if the user
+# is not a member.
+_group_leave = r.register_script(_GROUP_FLUSH + """
+if redis.call("ZREM", KEYS[3], ARGV[1]) == 0 then
+    return false
+end
+return flush(KEYS[1], KEYS[2], KEYS[3])
+""")
+
+# Appends a message ID to the group's queue. KEYS are group:{<id>}:queue,
+# group:{<id>}:offset and group:{<id>}:ids, ARGV[1] is the message ID,
+# ARGV[2] the sender and ARGV[3] the channel members are notified on.
+# A sender who has read everything skips their own message.
+# Returns 0 if the sender is not a member of the group.
+_group_send = r.register_script("""
+local cursor = redis.call("ZSCORE", KEYS[3], ARGV[2])
+if not cursor then
+    return 0
+end
+local tail = tonumber(redis.call("GET", KEYS[2]) or 0)
+    + redis.call("LLEN", KEYS[1])
+redis.call("RPUSH", KEYS[1], ARGV[1])
+if tonumber(cursor) == tail then
+    redis.call("ZADD", KEYS[3], tail + 1, ARGV[2])
+end
+redis.call("PUBLISH", ARGV[3], ARGV[1])
+return 1
+""")
+
+# Reads up to ARGV[2] message IDs from the group's queue starting at
+# the cursor of the user ARGV[1], advances the cursor and flushes the
+# queue. KEYS are the same as for `_group_send`. Returns the read IDs
+# and the trimmed IDs, or false if the user is not a member.
+_group_poll = r.register_script(_GROUP_FLUSH + """
+local cursor = redis.call("ZSCORE", KEYS[3], ARGV[1])
+if not cursor then
+    return false
+end
+cursor = tonumber(cursor)
+local start = cursor - tonumber(redis.call("GET", KEYS[2]) or 0)
+local read = redis.call(
+    "LRANGE", KEYS[1], start, start + tonumber(ARGV[2]) - 1
+)
+if #read == 0 then
+    return {read, {}}
+end
+redis.call("ZADD", KEYS[3], cursor + #read, ARGV[1])
+return {read, flush(KEYS[1], KEYS[2], KEYS[3])}
+""")
+
+# Moves up to ARGV[2] users who last polled before ARGV[1] from `ONLINE`
+# to `AWAY`, keeping their scores, and removes up to ARGV[2] users who last
+# polled before ARGV[3] from `AWAY`. KEYS are `ONLINE` and `AWAY` of the
+# node the script runs on. Returns the number of users moved and removed.
+_mark_away = r.register_script("""
+local idle = redis.call(
+    "ZRANGEBYSCORE", KEYS[1], "-inf", "(" .. ARGV[1],
+    "WITHSCORES", "LIMIT", 0, ARGV[2]
+)
+for i = 1, #idle, 2 do
+    redis.call("ZADD", KEYS[2], idle[i + 1], idle[i])
+    redis.call("ZREM", KEYS[1], idle[i])
+end
+local dormant = redis.call(
+    "ZRANGEBYSCORE", KEYS[2], "-inf", "(" .. ARGV[3], "LIMIT", 0, ARGV[2]
+)
+for _, key in ipairs(dormant) do
+    redis.call("ZREM", KEYS[2], key)
+end
+return {#idle / 2, #dormant}
+""")
+
+# Key of the deadlines of the elections of the groups stored on a node.
+# Unlike other keys, it exists on every node, so it is not routed by the
+# ring but read from every node by `sweep_elections`.
+DEADLINES = "elections:deadlines"
+
+# Shared by the election scripts below, which all take the KEYS returned by
+# `Election._keys`. Concludes an election, applying its verdict to the
+# members of the group. An election is accepted if at least `majority`
+# percent of the votes are yes, and rejected if nobody voted, for example
+# when it ran out of time. Returns the verdict, the kind of the
+# election and the IDs of the messages trimmed from the group's queue.
+_ELECTION_CONCLUDE = _GROUP_FLUSH + """
+local function conclude(candidate, majority, member)
+    local kind = redis.call("HGET", KEYS[1], "kind")
+    local yes = tonumber(redis.call("HGET", KEYS[1], "yes") or 0)
+    local votes = redis.call("SCARD", KEYS[2])
+    local verdict = "rejected"
+    local trimmed = {}
+    if votes > 0 and yes * 100 >= tonumber(majority) * votes then
+        verdict = "accepted"
+        if kind == "invite" then
+            local tail = tonumber(redis.call("GET", KEYS[4]) or 0)
+                + redis.call("LLEN", KEYS[3])
+            redis.call("ZADD", KEYS[5], "NX", tail, candidate)
+        elseif redis.call("ZREM", KEYS[5], candidate) == 1 then
+            trimmed = flush(KEYS[3], KEYS[4], KEYS[5])
+        end
+    end
+    redis.call("DEL", KEYS[1], KEYS[2])
+    redis.call("ZREM", KEYS[6], member)
+    redis.call("SREM", KEYS[7], candidate)
+    return {verdict, kind, trimmed}
+end
+"""
+
+# Starts an election of kind ARGV[1], "invite" or "kick", about the user
+# ARGV[2], called by the member ARGV[3]. A user may also call an election
+# to invite themselves. ARGV[4] is the deadline in milliseconds since the
+# epoch and ARGV[5] the member of the election in `DEADLINES`. Returns
+# "started", or the reason the election could not be started.
+_election_start = r.register_script("""
+if redis.call("EXISTS", KEYS[8]) == 0 then
+    return "missing"
+end
+local invite = ARGV[1] == "invite"
+if not redis.call("ZSCORE", KEYS[5], ARGV[3])
+        and not (invite and ARGV[2] == ARGV[3]) then
+    return "not_member"
+end
+local member = redis.call("ZSCORE", KEYS[5], ARGV[2])
+if invite and member then
+    return "member"
+elseif not invite and not member then
+    return "not_candidate"
+end
+if redis.call("EXISTS", KEYS[1]) == 1 then
+    return "running"
+end
+redis.call("HMSET", KEYS[1], "kind", ARGV[1], "deadline", ARGV[4], "yes", 0)
+redis.call("ZADD", KEYS[6], ARGV[4], ARGV[5])
+redis.call("SADD", KEYS[7], ARGV[2])
+return "started"
+""")
+
+# Casts the vote of the member ARGV[1], yes if ARGV[2] is 1, in the
+# election about the user ARGV[3]. The election is concluded once at least
+# ARGV[4] percent of the members other than the user have voted. ARGV[5]
+# is the majority and ARGV[6] the member of the election in `DEADLINES`.
+# Returns {"counted"}, the result of `conclude`, or {reason} if the vote
+# was not counted.
+_election_vote = r.register_script(_ELECTION_CONCLUDE + """
+if redis.call("EXISTS", KEYS[1]) == 0 then
+    return {"missing"}
+end
+if not redis.call("ZSCORE", KEYS[5], ARGV[1]) then
+    return {"not_member"}
+end
+if ARGV[1] == ARGV[3] then
+    return {"self"}
+end
+if redis.call("SADD", KEYS[2], ARGV[1]) == 0 then
+    return {"voted"}
+end
+if ARGV[2] == "1" then
+    redis.call("HINCRBY", KEYS[1], "yes", 1)
+end
+local electorate = redis.call("ZCARD", KEYS[5])
+if redis.call("ZSCORE", KEYS[5], ARGV[3]) then
+    electorate = electorate - 1
+end
+if redis.call("SCARD", KEYS[2]) * 100 >= tonumber(ARGV[4]) * electorate then
+    return conclude(ARGV[3], ARGV[5], ARGV[6])
+end
+return {"counted"}
+""")
+
+# Concludes the election about the user ARGV[1] if its deadline is at or
+# before ARGV[4], in milliseconds since the epoch. ARGV[2] is the majority
+# and ARGV[3] the member of the election in `DEADLINES`, which is removed
+# if the election no longer exists. Returns the result of `conclude`, or
+# false if the election was not concluded.
+_election_expire = r.register_script(_ELECTION_CONCLUDE + """
+local deadline = redis.call("HGET", KEYS[1], "deadline")
+if not deadline then
+    redis.call("ZREM", KEYS[6], ARGV[3])
+    return false
+end
+if tonumber(deadline) > tonumber(ARGV[4]) then
+    return false
+end
+return conclude(ARGV[1], ARGV[2], ARGV[3])
+""")
+
+
+@metrics.instrument
 class DBModel(object):
     """
     Representation of a database object.
+
+    Only the attributes listed in `fields` are stored, and
+    objects expire after `ttl` seconds unless it is None.
     """
+    fields = ()
+    ttl = None
+
     def __init__(self, obj_type, obj_id):
         """
         Creates a new object with the following data:
         * obj_type - Object type
         * obj_id - Object ID
 
-        The object will be located at "obj_type:obj_id"
+        The object will be located at "obj_type:{obj_id}"
         after it is created. The key of the object can
-        be accessed using `obj.key`.
+        be accessed using `obj.key`. Keys of the object's
+        queues and counters start with its key, so that
+        they are stored on the same node.
         """
         self.type = obj_type
         self.id = obj_id
-        self.key = "%s:%s" % (self.type, self.id)
+        self.key = "%s:{%s}" % (self.type, self.id)
 
         self.created_at = None
 
-    @not_exists
     def new(self):
         """
         Creates a new object in the database.
         """
-        self.created_at = datetime.now()
-        for k, v in self.__dict__.iteritems():
-            self.set(k, v)
+        self.created_at = timestamp()
+        args = [self.ttl or 0]
+        for field in self.fields:
+            args.extend((field, getattr(self, field)))
+        if not _new(keys=[self.key], args=args):
+            raise ValueError(
+                "Object %s already exists in the database." % self.key
+            )
 
-    @exists
     def delete(self):
         """
         Delete the object in the database.
         """
-        r.delete(self.key)
+        if not r.delete(self.key):
+            raise does_not_exist(self.key)
 
-    @exists
     def get(self):
         """
         Returns user information.
         """
-        return r.hgetall(self.key)
+        data = r.hgetall(self.key)
+        if not data:
+            raise does_not_exist(self.key)
+        data["id"] = self.id
+        return data
 
     def set(self, field, value):
         """
@@ -106,7 +781,6 @@ class DBModel(object):
         setattr(self, field, value)
         r.hset(self.key, field, value)
 
-    @exists
     def load(self):
         """
         Load object information from the database.
@@ -114,12 +788,16 @@ class DBModel(object):
         for k, v in self.get().iteritems():
             setattr(self, k, v)
 
+@metrics.instrument
 class Message(DBModel):
     """
     Class representing a message.
     """
+    fields = ("sender", "content", "stamp", "group")
+    ttl = config.MESSAGE_TTL
 
-    def __init__(self, msg_id, sender="", content="", stamp=datetime.now()):
+    def __init__(self, msg_id, sender="", content="", stamp=None,
+                 group=""):
         """
         Creates a message given the following parameters:
         * msg_id - ID of the message.
@@ -127,43 +805,129 @@ class Message(DBModel):
         Parameters:
         * sender - Username of the sender.
         * content - Content of the message.
-        * stamp - Timestamp of the message.
-                  Default is the current time.
+        * stamp - Timestamp of the message in milliseconds
+                  since the epoch. Default is the current time.
+        * group - Name of the group the message was sent in.
+                  Default is a private message.
         """
         DBModel.__init__(self, "message", msg_id)
         self.sender = sender
         self.content = content
-        self.stamp = stamp
+        self.stamp = stamp or timestamp()
+        self.group = group
+
+    def new(self):
+        """
+        Creates the message in the database, packed
+        by the serializer set in `config.MESSAGE_SERIALIZER`.
+        """
+        if not serializer.packed:
+            return DBModel.new(self)
+
+        fields = dict((field, getattr(self, field)) for field in self.fields)
+        value = serializer.dumps(fields)
+        if not r.set(self.key, value, ex=self.ttl, nx=True):
+            raise ValueError(
+                "Object %s already exists in the database." % self.key
+            )
+
+    def get(self):
+        """
+        Returns message information.
+        """
+        data = read_messages([self.id])[0]
+        if data is None:
+            raise does_not_exist(self.key)
+        data["id"] = self.id
+        return data
 
-    @exists
     def delete(self):
-        DBModel.delete(self)
-        r.delete("%s:count" % self.key)
+        pipe = r.pipeline(self.key)
+        pipe.delete(self.key)
+        pipe.delete("%s:count" % self.key)
+        if not pipe.execute()[0]:
+            raise does_not_exist(self.key)
 
-    @exists
     def send_users(self, users):
         """
         Send a list of users the message.
+
+        If the message and its recipients are stored on the same
+        node, the recipients are checked and the message is queued
+        for all of them at once, so the cost does not grow with
+        the number of round trips to the database. Otherwise this
+        takes a few round trips to every node, see `_send_nodes`.
         """
-        r.set("%s:count" % self.key, len(users))
-        for username in users:
-            user = User(username)
-            user.load()
-            user.send(self.id)
+        users = [User(username) for username in set(users)]
+        counter = [self.key, "%s:count" % self.key]
+        if len(r.partition([user.key for user in users] + [self.key])) == 1:
+            keys = []
+            for user in users:
+                keys.extend((user.key, "%s:queue" % user.key))
+            missing = _send_users(
+                keys=keys + counter + [ONLINE],
+                args=[self.id, away_cutoff(), ids.stamp(self.id)]
+            )
+        else:
+            missing = self._send_nodes(users, counter)
+        if missing:
+            raise ValueError(
+                "Objects %s do not exist in the database." % ", ".join(missing)
+            )
+
+    def _send_nodes(self, users, counter):
+        """
+        Sends the message to users stored on several nodes.
+        Returns the keys of the objects which do not exist.
+
+        All recipients are checked before the counter is set and
+        the message is queued on every node, so that nothing is
+        sent if a recipient is missing. Recipients deleted in the
+        meantime are skipped and counted as having recieved it.
+        Only online recipients are notified, see `_NOTIFY`.
+        """
+        nodes = r.partition(users, key=lambda user: user.key)
+        missing = []
+        for client, node_users in nodes:
+            pipe = client.pipeline(transaction=False)
+            for user in node_users:
+                pipe.exists(user.key)
+            missing.extend(
+                user.key
+                for user, found in zip(node_users, pipe.execute())
+                if not found
+            )
+        if missing:
+            return missing
+        if not _reserve(keys=counter, args=[len(users)]):
+            return [self.key]
+
+        skipped = 0
+        args = [self.id, away_cutoff(), ids.stamp(self.id)]
+        for client, node_users in nodes:
+            keys = []
+            for user in node_users:
+                keys.extend((user.key, "%s:queue" % user.key))
+            skipped += len(_push(
+                keys=keys + [ONLINE], args=args, client=client
+            ))
+        if skipped:
+            _recieved(keys=counter * skipped)
+        return []
 
-    @exists
     def recieved(self):
         """
         Mark the message to be recieved by a user.
         """
-        val = r.decr("%s:count" % self.key)
-        if val == 0:
-            self.delete()
+        if not _recieved(keys=[self.key, "%s:count" % self.key]):
+            raise does_not_exist(self.key)
 
+@metrics.instrument
 class User(DBModel):
     """
     Class representing User object.
     """
+    fields = ("email", "phone_no", "created_at")
 
     def __init__(self, username, email="", phone_no=""):
         """
@@ -178,31 +942,756 @@ class User(DBModel):
         self.email = email
         self.phone_no = phone_no
 
-    @exists
+    def new(self):
+        DBModel.new(self)
+        user_cache.invalidate(self.key)
+
+    def get(self):
+        """
+        Returns user information, from `user_cache`
+        if it has been read recently.
+        """
+        data = user_cache.get(self.key)
+        if data is None:
+            data = DBModel.get(self)
+            user_cache.set(self.key, data)
+        return dict(data)
+
+    def set(self, field, value):
+        setattr(self, field, value)
+        pipe = r.pipeline(self.key)
+        pipe.hset(self.key, field, value)
+        user_cache.invalidate(self.key, pipe)
+        pipe.execute()
+
     def delete(self):
-        DBModel.delete(self)
-        r.delete("%s:queue" % self.key)
+        """
+        Deletes the user, removes them from their groups and
+        marks all messages left in their queue as recieved.
+
+        The queue is moved to a key of its own before it is
+        drained, so that a user who signs up again with the
+        same username starts with an empty queue. Queues left
+        behind by an interrupted delete are drained by the
+        compactor.
 
-    @exists
-    def poll(self):
+        Groups the user is no longer a member of, because they
+        were deleted or the user was kicked after the group was
+        added to the groups of the user, are skipped.
+        """
+        queue = "%s:queue:deleted:%s" % (self.key, uuid.uuid4().hex)
+        keys = [self.key, "%s:queue" % self.key, queue, ONLINE, AWAY]
+        if not _delete_user(keys=keys):
+            raise does_not_exist(self.key)
+        user_cache.invalidate(self.key)
+
+        try:
+            for groupname in self.groups():
+                try:
+                    Group(groupname).leave(self.id)
+                except ValueError:
+                    pass
+            r.delete("%s:groups" % self.key)
+        finally:
+            drain_queue(queue)
+
+    def groups(self):
+        """
+        Returns the names of the groups the user is in.
+        """
+        return r.smembers("%s:groups" % self.key)
+
+    def channels(self):
+        """
+        Returns the channels the user is notified
+        of new messages on.
+        """
+        channels = [notify.channel(self.key)]
+        for groupname in self.groups():
+            channels.append(notify.channel(Group(groupname).key))
+        return channels
+
+    def poll(self, limit=None, wait=None):
         """
         Pops messages from the user's queue.
+
+        Messages are popped in batches of `config.POLL_BATCH_SIZE`,
+        each batch taking a round trip to the node of the user and
+        two to every node the messages of the batch are stored on.
+
+        Parameters:
+        * limit - Maximum number of messages to pop.
+                  Default is to pop all of them.
+        * wait - Seconds to wait for a message to arrive
+                 if there are none. Default is not to wait.
+        """
+        return list(self.stream(limit, wait))
+
+    def stream(self, limit=None, wait=None):
+        """
+        Pops messages from the user's queue like `poll`, but yields
+        them as every batch is popped, so that no more than a batch
+        is held in memory. Messages are popped before they are
+        yielded, so those of a batch which is not consumed are lost.
+
+        Parameters:
+        * limit - Maximum number of messages to pop.
+                  Default is to pop all of them.
+        * wait - Seconds to wait for a message to arrive
+                 if there are none. Default is not to wait.
+        """
+        if not wait:
+            for data in self._poll(limit):
+                yield data
+            return
+
+        with notify.notifier.listen(self.channels()) as event:
+            found = False
+            for data in self._poll(limit):
+                found = True
+                yield data
+            if not found and event.wait(wait):
+                for data in self._poll(limit):
+                    yield data
+
+    def _poll(self, limit):
+        """
+        Pops messages from the user's queue without waiting,
+        yielding them batch by batch. The user is marked online
+        in the same round trip as the first batch.
+        """
+        queue = "%s:queue" % self.key
+        count = 0
+        seen = False
+        while limit is None or count < limit:
+            size = config.POLL_BATCH_SIZE
+            if limit is not None:
+                size = min(size, limit - count)
+
+            pipe = r.pipeline(self.key)
+            pipe.exists(self.key)
+            pipe.zrange(queue, 0, size - 1)
+            pipe.zremrangebyrank(queue, 0, size - 1)
+            if not seen:
+                pipe.zadd(ONLINE, timestamp(), self.key)
+                pipe.zrem(AWAY, self.key)
+                seen = True
+            found, msg_ids = pipe.execute()[:2]
+            if not found:
+                r.node(self.key).zrem(ONLINE, self.key)
+                raise does_not_exist(self.key)
+            if not msg_ids:
+                break
+
+            batch = []
+            for msg_id, data in zip(msg_ids, read_messages(msg_ids)):
+                if data:
+                    data["id"] = msg_id
+                    batch.append(data)
+            recieve_messages(msg_ids)
+
+            count += len(batch)
+            for data in batch:
+                yield data
+
+            if len(msg_ids) < size:
+                break
+
+        for groupname in self.groups():
+            if limit is not None and count >= limit:
+                break
+            remaining = None if limit is None else limit - count
+            try:
+                for data in Group(groupname).stream(self.id, remaining):
+                    count += 1
+                    yield data
+            except ValueError:
+                # The user left or was removed from the group, which is
+                # only then removed from their groups. The messages
+                # popped above are already marked as recieved, so the
+                # group is skipped rather than failing the poll, and
+                # removed unless the user was invited again meanwhile.
+                ids = "%s:ids" % Group(groupname).key
+                if r.zscore(ids, self.id) is None:
+                    r.srem("%s:groups" % self.key, groupname)
+
+    def presence(self):
         """
+        Returns the status of the user, "online", "away" or
+        "offline" if they have not polled for
+        `config.PRESENCE_FORGET` seconds, and the time they
+        last polled at in milliseconds since the epoch.
+        """
+        pipe = r.pipeline(self.key, transaction=False)
+        pipe.exists(self.key)
+        pipe.zscore(ONLINE, self.key)
+        pipe.zscore(AWAY, self.key)
+        found, online, away = pipe.execute()
+        if not found:
+            raise does_not_exist(self.key)
+        if online is not None and online >= away_cutoff():
+            return "online", int(online)
+        if online is None and away is None:
+            return "offline", None
+        return "away", int(away if online is None else online)
+
+    def read(self, after=None, limit=None):
+        """
+        Returns messages from the user's queue without popping them,
+        whether there are more messages after them and the cursor to
+        read them from. Messages stay in the queue until they are
+        acknowledged with `ack`, so a read can safely be repeated.
+
+        The queue is a sorted set ordered by message ID, scored by
+        the time the ID was allocated at. IDs allocated in the same
+        millisecond have as many digits, so they are ordered by
+        value as strings. Reading after a message is a range query
+        whether or not the message is still in the queue.
+
+        Parameters:
+        * after - ID of the last message read. Default is to
+                  read from the first message not acknowledged.
+        * limit - Maximum number of messages to return. Default
+                  is `config.READ_DEFAULT_LIMIT`.
+        """
+        limit = limit or config.READ_DEFAULT_LIMIT
+        msg_ids = _read_queue(
+            keys=[self.key, "%s:queue" % self.key],
+            args=[after or "", ids.stamp(after) if after else 0, limit]
+        )
+        if msg_ids is None:
+            raise does_not_exist(self.key)
+
+        more = len(msg_ids) > limit
+        msg_ids = msg_ids[:limit]
         msg_lst = []
+        for msg_id, data in zip(msg_ids, read_messages(msg_ids)):
+            if data:
+                data["id"] = msg_id
+                msg_lst.append(data)
+        cursor = msg_ids[-1] if msg_ids else after
+        return msg_lst, more, cursor
+
+    def ack(self, msg_id):
+        """
+        Acknowledges the messages in the user's queue up to
+        and including the given ID, popping them from the queue
+        and marking them as recieved. Returns the number of
+        acknowledged messages, which is 0 if they already were.
+        Messages are popped `config.POLL_BATCH_SIZE` at a time.
+        """
+        count = 0
+        size = config.POLL_BATCH_SIZE
         while True:
-            msg_id = r.lpop("%s:queue" % self.key)
-            if not msg_id:
-                break
-            msg = Message(msg_id)
-            msg.load()
-            msg_lst.append(msg.get())
-            msg.recieved()
-        return msg_lst
+            msg_ids = _ack_queue(
+                keys=[self.key, "%s:queue" % self.key], args=[msg_id, size]
+            )
+            if msg_ids is None:
+                raise does_not_exist(self.key)
+            recieve_messages(msg_ids)
+            count += len(msg_ids)
+            if len(msg_ids) < size:
+                return count
 
-    @exists
     def send(self, msg_id):
         """
         Add a message into the user's queue
         given the ID of the message.
         """
-        r.rpush("%s:queue" % self.key, msg_id)
+        keys = [self.key, "%s:queue" % self.key, ONLINE]
+        args = [msg_id, away_cutoff(), ids.stamp(msg_id)]
+        if not _send(keys=keys, args=args):
+            raise does_not_exist(self.key)
+
+@metrics.instrument
+class Group(DBModel):
+    """
+    Class representing a group chat.
+
+    Messages sent to a group are stored once, in a queue
+    shared by all of its members. Every member has a cursor
+    into the queue and messages are trimmed from the queue
+    once all of the members have read them.
+    """
+    fields = ("created_at",)
+
+    def __init__(self, groupname):
+        """
+        Creates a group given the following parameters:
+        * groupname - Name of the group.
+        """
+        DBModel.__init__(self, "group", groupname)
+
+    def _keys(self):
+        """
+        Returns the keys of the group's queue, offset and cursors.
+        """
+        return [
+            "%s:queue" % self.key,
+            "%s:offset" % self.key,
+            "%s:ids" % self.key
+        ]
+
+    def _delete_messages(self, msg_ids):
+        """
+        Deletes messages trimmed from the group's queue.
+        """
+        keys = [Message(msg_id).key for msg_id in msg_ids]
+        for client, node_keys in r.partition(keys):
+            client.delete(*node_keys)
+
+    def new(self, username):
+        """
+        Creates the group with the user as its first member.
+
+        The user and the group may be stored on different nodes,
+        so the user is checked before the group is created, and
+        the group is deleted again if the user was deleted before
+        joining it. No group is left without its creator.
+        """
+        user = User(username)
+        if not r.exists(user.key):
+            raise does_not_exist(user.key)
+        DBModel.new(self)
+        try:
+            self._join(username)
+        except ValueError:
+            r.delete(self.key)
+            raise
+
+    def delete(self):
+        """
+        Deletes the group, its running elections and its
+        messages, and removes it from the groups of its members.
+        """
+        queue, _, ids = self._keys()
+        elections = "%s:elections" % self.key
+        pipe = r.pipeline(self.key)
+        pipe.zrange(ids, 0, -1)
+        pipe.lrange(queue, 0, -1)
+        pipe.smembers(elections)
+        pipe.delete(self.key)
+        pipe.delete(elections, *self._keys())
+        members, msg_ids, usernames, deleted, _ = pipe.execute()
+        if not deleted:
+            raise does_not_exist(self.key)
+
+        # Running elections are deleted, so they are never concluded.
+        pipe = r.pipeline(self.key)
+        for username in usernames:
+            election = Election(self.id, username)
+            pipe.delete(election.key, "%s:voters" % election.key)
+            pipe.zrem(DEADLINES, election.member)
+        pipe.execute()
+
+        keys = ["%s:groups" % User(username).key for username in members]
+        for client, node_keys in r.partition(keys):
+            pipe = client.pipeline(transaction=False)
+            for key in node_keys:
+                pipe.srem(key, self.id)
+            pipe.execute()
+        self._delete_messages(msg_ids)
+
+    def members(self):
+        """
+        Returns the usernames of the members of the group.
+        """
+        return r.zrange("%s:ids" % self.key, 0, -1)
+
+    def elections(self):
+        """
+        Returns the elections running in the group.
+        """
+        elections = []
+        for username in r.smembers("%s:elections" % self.key):
+            try:
+                elections.append(Election(self.id, username).get())
+            except ValueError:
+                # The election was concluded in the meantime.
+                pass
+        return elections
+
+    def _join(self, username):
+        """
+        Adds a user to the group. The user will only
+        recieve messages sent after they joined. Only used
+        for the creator of the group, other members join
+        by an election, see `Election`.
+
+        The user and the group may be stored on different
+        nodes, so the user is added to the group before the
+        group is added to the groups of the user.
+        """
+        user = User(username)
+        if not r.exists(user.key):
+            raise does_not_exist(user.key)
+        if not _group_join(keys=self._keys() + [self.key], args=[username]):
+            raise does_not_exist(self.key)
+        r.sadd("%s:groups" % user.key, self.id)
+
+    def leave(self, username):
+        """
+        Removes a user from the group.
+        """
+        trimmed = _group_leave(keys=self._keys(), args=[username])
+        if trimmed is None:
+            raise ValueError(
+                "User %s is not a member of group %s." % (username, self.id)
+            )
+        r.srem("%s:groups" % User(username).key, self.id)
+        if trimmed:
+            self._delete_messages(trimmed)
+
+    def send(self, msg_id, sender):
+        """
+        Append a message to the group's queue given the
+        ID of the message and the username of the sender.
+        """
+        args = [msg_id, sender, notify.channel(self.key)]
+        if not _group_send(keys=self._keys(), args=args):
+            raise ValueError(
+                "User %s is not a member of group %s." % (sender, self.id)
+            )
+
+    def poll(self, username, limit=None):
+        """
+        Returns the messages the user has not read yet
+        and moves the user's cursor past them.
+
+        Parameters:
+        * limit - Maximum number of messages to return.
+                  Default is to return all of them.
+        """
+        return list(self.stream(username, limit))
+
+    def stream(self, username, limit=None):
+        """
+        Yields the messages the user has not read yet like `poll`,
+        moving the user's cursor past them batch by batch.
+
+        Parameters:
+        * limit - Maximum number of messages to yield.
+                  Default is to yield all of them.
+        """
+        count = 0
+        while limit is None or count < limit:
+            size = config.POLL_BATCH_SIZE
+            if limit is not None:
+                size = min(size, limit - count)
+
+            result = _group_poll(keys=self._keys(), args=[username, size])
+            if result is None:
+                raise ValueError(
+                    "User %s is not a member of group %s." % (username, self.id)
+                )
+            msg_ids, trimmed = result
+            if not msg_ids:
+                break
+
+            # Trimmed messages are only deleted after they have been read.
+            for msg_id, data in zip(msg_ids, read_messages(msg_ids, trimmed)):
+                if data and data.get("sender") != username:
+                    data["id"] = msg_id
+                    count += 1
+                    yield data
+
+            if len(msg_ids) < size:
+                break
+
+@metrics.instrument
+class Election(object):
+    """
+    Class representing a vote of the members of a group on
+    inviting a user to the group or kicking a user from it.
+
+    Every vote is cast by a single script, which records the
+    voter, counts the vote and concludes the election once
+    enough members have voted, so members can vote at the same
+    time from any process. Elections which run out of time are
+    concluded by `sweep_elections`.
+    """
+    # Notes sent to the user an election is about, by kind and verdict.
+    notes = {
+        ("invite", "accepted"): "You have been added to the group '%s'.",
+        ("invite", "rejected"): "You have been denied access to '%s'.",
+        ("kick", "accepted"): "You have been kicked from the group '%s'.",
+        ("kick", "rejected"): "The vote to kick you from '%s' has failed.",
+    }
+    errors = {
+        "missing": "There is no election about user %s in group %s.",
+        "not_member": "User %s is not a member of group %s.",
+        "member": "User %s is already a member of group %s.",
+        "not_candidate": "User %s is not a member of group %s.",
+        "running": "An election about user %s in group %s is running.",
+        "self": "User %s cannot vote in an election about themselves in %s.",
+        "voted": "User %s has already voted in this election in group %s.",
+    }
+
+    def __init__(self, groupname, username):
+        """
+        Creates an election given the following parameters:
+        * groupname - Name of the group.
+        * username - Username of the user the election is about.
+        """
+        self.group = Group(groupname)
+        self.username = username
+        self.key = "%s:election:%s" % (self.group.key, username)
+        self.member = json.dumps([groupname, username])
+
+    def _keys(self):
+        """
+        Returns the keys of the election, its voters, the group's
+        queue, offset and cursors, `DEADLINES`, the group's
+        elections and the group, in the order the scripts use.
+        """
+        return [self.key, "%s:voters" % self.key] + self.group._keys() + [
+            DEADLINES,
+            "%s:elections" % self.group.key,
+            self.group.key
+        ]
+
+    def _error(self, reason, username):
+        return ValueError(self.errors[reason] % (username, self.group.id))
+
+    def start(self, kind, username):
+        """
+        Starts an election, which is either an "invite" or
+        a "kick", called by a member of the group. A user may
+        also ask to be invited. Returns the deadline of the
+        election, in milliseconds since the epoch.
+        """
+        if kind not in ("invite", "kick"):
+            raise ValueError("Election kind must be 'invite' or 'kick'.")
+        if kind == "invite" and not r.exists(User(self.username).key):
+            raise does_not_exist(User(self.username).key)
+
+        deadline = timestamp() + config.ELECTION_DURATION * 1000
+        args = [kind, self.username, username, deadline, self.member]
+        reason = _election_start(keys=self._keys(), args=args)
+        if reason == "missing":
+            raise does_not_exist(self.group.key)
+        if reason in ("member", "not_candidate"):
+            raise self._error(reason, self.username)
+        if reason != "started":
+            raise self._error(reason, username)
+        return deadline
+
+    def get(self):
+        """
+        Returns election information.
+        """
+        pipe = r.pipeline(self.key)
+        pipe.hgetall(self.key)
+        pipe.scard("%s:voters" % self.key)
+        data, votes = pipe.execute()
+        if not data:
+            raise self._error("missing", self.username)
+        yes = int(data["yes"])
+        return {
+            "group": self.group.id,
+            "user": self.username,
+            "kind": data["kind"],
+            "deadline": int(data["deadline"]),
+            "yes": yes,
+            "no": votes - yes
+        }
+
+    def vote(self, username, yes):
+        """
+        Casts the vote of a member of the group. Returns
+        "counted", or the verdict, "accepted" or "rejected",
+        if the vote concluded the election.
+        """
+        args = [
+            username,
+            int(bool(yes)),
+            self.username,
+            config.ELECTION_TURNOUT,
+            config.ELECTION_MAJORITY,
+            self.member
+        ]
+        result = _election_vote(keys=self._keys(), args=args)
+        if result[0] == "counted":
+            return "counted"
+        if len(result) == 1:
+            raise self._error(result[0], username)
+        return self._conclude(*result)
+
+    def expire(self, now=None):
+        """
+        Concludes the election if it has run out of time.
+        Returns the verdict, or None if it was not concluded.
+        """
+        args = [
+            self.username,
+            config.ELECTION_MAJORITY,
+            self.member,
+            now or timestamp()
+        ]
+        result = _election_expire(keys=self._keys(), args=args)
+        if result is None:
+            return None
+        return self._conclude(*result)
+
+    def _conclude(self, verdict, kind, trimmed):
+        """
+        Applies the verdict of a concluded election to the user
+        it was about, and sends the user a note about it.
+        """
+        user = User(self.username)
+        if verdict == "accepted" and kind == "invite":
+            r.sadd("%s:groups" % user.key, self.group.id)
+        elif verdict == "accepted" and kind == "kick":
+            r.srem("%s:groups" % user.key, self.group.id)
+            if trimmed:
+                self.group._delete_messages(trimmed)
+
+        note = self.notes[(kind, verdict)] % self.group.id
+        try:
+            send_message(SYSTEM, note, recipients=[self.username])
+        except ValueError:
+            # The user was deleted while the election was running.
+            if verdict == "accepted" and kind == "invite":
+                self.group.leave(self.username)
+        return verdict
+
+def sweep_elections(now=None):
+    """
+    Concludes the elections which have run out of time, reading
+    `config.ELECTION_SWEEP_BATCH` of them at a time from the
+    `DEADLINES` of every node. Returns the number concluded.
+    """
+    now = now or timestamp()
+    batch = config.ELECTION_SWEEP_BATCH
+    concluded = 0
+    for client in r.nodes():
+        while True:
+            members = client.zrangebyscore(DEADLINES, 0, now, 0, batch)
+            for member in members:
+                groupname, username = json.loads(member)
+                if Election(groupname, username).expire(now):
+                    concluded += 1
+            if len(members) < batch:
+                break
+    return concluded
+
+def away_cutoff(now=None):
+    """
+    Returns the time in milliseconds since the epoch users
+    who last polled before are away.
+    """
+    return (now or timestamp()) - config.PRESENCE_AWAY * 1000
+
+def presence_page(ranges, offset, limit):
+    """
+    Returns a page of users, most recently seen first, as
+    (username, time they last polled at) tuples, and whether
+    there are more. Every node is read in one round trip, up
+    to `offset` + `limit` users from each range.
+
+    Parameters:
+    * ranges - (key, max, min) ranges of the time users last
+               polled at, read from the key on every node.
+    """
+    seen = []
+    for client in r.nodes():
+        pipe = client.pipeline(transaction=False)
+        for key, high, low in ranges:
+            pipe.zrevrangebyscore(
+                key, high, low, start=0, num=offset + limit + 1,
+                withscores=True
+            )
+        for entries in pipe.execute():
+            seen.extend(entries)
+    seen.sort(key=lambda (key, score): (-score, key))
+    page = [
+        (shards.hash_tag(key), int(score))
+        for key, score in seen[offset:offset + limit]
+    ]
+    return page, len(seen) > offset + limit
+
+def online_users(offset=0, limit=None, now=None):
+    """
+    Returns a page of the users who are online, see
+    `presence_page`, reading `ONLINE` of every node.
+
+    Parameters:
+    * offset - Number of users skipped.
+    * limit - Maximum number of users returned. Default
+              is `config.PRESENCE_DEFAULT_LIMIT`.
+    """
+    limit = limit or config.PRESENCE_DEFAULT_LIMIT
+    ranges = [(ONLINE, "+inf", away_cutoff(now))]
+    return presence_page(ranges, offset, limit)
+
+def away_users(since=None, offset=0, limit=None, now=None):
+    """
+    Returns a page of the users who are away, see
+    `presence_page`, reading `AWAY` and the users in `ONLINE`
+    which have not been swept yet on every node.
+
+    Parameters:
+    * since - Only return the users who polled at or after
+              this time, in milliseconds since the epoch.
+    * offset - Number of users skipped.
+    * limit - Maximum number of users returned. Default
+              is `config.PRESENCE_DEFAULT_LIMIT`.
+    """
+    since = "-inf" if since is None else since
+    limit = limit or config.PRESENCE_DEFAULT_LIMIT
+    ranges = [
+        (AWAY, "+inf", since),
+        (ONLINE, "(%d" % away_cutoff(now), since)
+    ]
+    return presence_page(ranges, offset, limit)
+
+def sweep_presence(now=None):
+    """
+    Moves the users who have not polled for `config.PRESENCE_AWAY`
+    seconds from `ONLINE` to `AWAY`, and forgets the users who have
+    not polled for `config.PRESENCE_FORGET` seconds, at most
+    `config.PRESENCE_SWEEP_BATCH` of each on every node, so that
+    a sweep takes one round trip to every node. Users left over
+    are swept by the following sweeps. Returns the number of
+    users moved and forgotten.
+    """
+    now = now or timestamp()
+    args = [
+        away_cutoff(now),
+        config.PRESENCE_SWEEP_BATCH,
+        now - config.PRESENCE_FORGET * 1000
+    ]
+    moved = forgotten = 0
+    for client in r.nodes():
+        result = _mark_away(keys=[ONLINE, AWAY], args=args, client=client)
+        moved += result[0]
+        forgotten += result[1]
+    return moved, forgotten
+
+def send_message(sender, content, recipients=(), group=None, msg_id=None):
+    """
+    Stores a message once and sends its ID to a group
+    or to a list of users. Returns the message.
+
+    Parameters:
+    * recipients - Usernames of the recipients.
+    * group - Name of the group to send the message to,
+              instead of a list of recipients.
+    * msg_id - ID of the message. Default is a new ID.
+    """
+    msg = Message(
+        msg_id or new_id("message"),
+        sender=sender,
+        content=content,
+        group=group or ""
+    )
+    msg.new()
+    try:
+        if group:
+            Group(group).send(msg.id, sender)
+        else:
+            msg.send_users(recipients)
+    except ValueError:
+        msg.delete()
+        raise
+    return msg
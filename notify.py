@@ -0,0 +1,137 @@
+"""
+Copyright 2014 VoterChat
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import redis
+
+import logs
+from main import r
+
+def channel(key):
+    """
+    Returns the channel notifications about
+    an object are published on, given its key.
+    """
+    return "notify:%s" % key
+
+class Notifier(object):
+    """
+    Wakes up requests waiting for messages.
+
+    A single pub/sub connection per process and node listens to
+    every notification channel and sets the events of the requests
+    waiting on it, so a waiting request costs an event instead of
+    a connection to the database. Notifications are published on
+    the node of the object they are about. This is meant to be run
+    on a gevent worker, where the listeners and every waiting
+    request are greenlets instead of threads.
+
+    Handlers can also be registered to be called with the data
+    of every notification published on a channel.
+    """
+
+    def __init__(self):
+        self.waiters = defaultdict(set)
+        self.handlers = defaultdict(list)
+        self.lock = threading.Lock()
+        self.threads = []
+
+    def start(self):
+        """
+        Start listening for notifications,
+        if the notifier is not already listening.
+        """
+        with self.lock:
+            if not self.threads:
+                for client in r.nodes():
+                    thread = threading.Thread(target=self.run, args=(client,))
+                    thread.daemon = True
+                    thread.start()
+                    self.threads.append(thread)
+
+    def run(self, client):
+        """
+        Listen for notifications published on a node
+        and wake up the waiting requests.
+        """
+        while True:
+            try:
+                pubsub = client.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(channel("*"))
+                # Notifications may have been missed while reconnecting.
+                self.dispatch(None)
+                for message in pubsub.listen():
+                    with self.lock:
+                        events = list(self.waiters.get(message["channel"], ()))
+                    for event in events:
+                        event.set()
+                    self.dispatch(message["channel"], message["data"])
+            except redis.ConnectionError:
+                logs.event("notify_reconnect", level="WARNING")
+                time.sleep(1)
+
+    def dispatch(self, name, data=None):
+        """
+        Call the handlers of a channel with the data of a
+        notification. If the channel is None, every handler
+        is called with None, as notifications may have been
+        missed.
+        """
+        with self.lock:
+            if name is None:
+                handlers = sum(self.handlers.values(), [])
+            else:
+                handlers = list(self.handlers.get(name, ()))
+        for handler in handlers:
+            handler(data)
+
+    def on(self, name, handler):
+        """
+        Call the handler with the data of every
+        notification published on the channel.
+        """
+        with self.lock:
+            self.handlers[name].append(handler)
+        self.start()
+
+    @contextmanager
+    def listen(self, channels):
+        """
+        Returns an event which is set when a notification
+        is published on any of the channels.
+
+        Messages should be polled for after listening, so
+        that none are missed between polling and waiting.
+        """
+        self.start()
+        event = threading.Event()
+        with self.lock:
+            for name in channels:
+                self.waiters[name].add(event)
+        try:
+            yield event
+        finally:
+            with self.lock:
+                for name in channels:
+                    self.waiters[name].discard(event)
+                    if not self.waiters[name]:
+                        del self.waiters[name]
+
+notifier = Notifier()
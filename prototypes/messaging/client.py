@@ -10,8 +10,12 @@ print "Your username is", username
 serverurl = "http://localhost:8080/api"
 print "Using the server", serverurl
 
+# All commands go through one session, which keeps its connection to the server alive between commands.
+session = requests.Session()
+session.headers.update({"Content-type": "application/json", "Accept": "application/json"})
 
-def sendcommand(command, groupname=None, message=None, otheruser=None):
+
+def makecommand(command, groupname=None, message=None, otheruser=None):
     data = {"user": username, "command": command}
     if groupname:
         data.update({"group": groupname})
@@ -19,13 +23,30 @@ def sendcommand(command, groupname=None, message=None, otheruser=None):
         data.update({"message": message})
     if otheruser:
         data.update({"otheruser": otheruser})
+    return data
+
+def post(data):
     try:
-        headers = {"Content-type": "application/json", "Accept": "application/json"}
-        r = requests.post(serverurl, data=json.dumps(data), headers=headers)
+        r = session.post(serverurl, data=json.dumps(data))
     except requests.exceptions.ConnectionError:
         return 0, "Error: Can't connect to server. You need to run the server first, using 'python server.py'"
     return r.status_code, json.loads(r.text)
 
+def sendcommand(command, groupname=None, message=None, otheruser=None):
+    return post(makecommand(command, groupname, message, otheruser))
+
+def sendcommands(commands):
+    """Send a list of commands made by makecommand() in one request. Returns the status and a list of results."""
+    return post(commands)
+
+def showmessages(response):
+    if "messages" in response:
+        print "\nYou got messages:\n"
+        for msg in response["messages"]:
+            sender, group, message = msg
+            print "From %s@%s: %s" % (sender, group, message)
+        print
+
 class Client(cmd.Cmd):
     def __init__(self, name=""):
         self.intro = "Type '?' for a list of commands a GUI would send to the server. The commands are:\n" \
@@ -54,12 +75,8 @@ class Client(cmd.Cmd):
     def do_poll(self, arg=None):
         status, response = sendcommand("poll")
         print status, response
-        if status == 200 and "messages" in response:
-            print "\nYou got messages:\n"
-            for msg in response["messages"]:
-                sender, group, message = msg
-                print "From %s@%s: %s" % (sender, group, message)
-            print
+        if status == 200:
+            showmessages(response)
         
     def emptyline(self): # Just pressing Enter is a shortcut for 'poll'.
         self.do_poll()
@@ -74,27 +91,32 @@ class Client(cmd.Cmd):
             print "Usage: send groupname message"
             return
         groupname, message = parts
-        status, response = sendcommand("send", groupname, message)
-        print status, response
+        # Poll in the same request, to pick up the replies without another round trip.
+        status, responses = sendcommands([makecommand("send", groupname, message), makecommand("poll")])
+        print status, responses
+        if status == 200:
+            showmessages(responses[1])
         
-    def do_invite(self, arg):
-        # TODO: factor out, parametrize for invite and kick
+    def election_command(self, command, arg):
         parts = arg.split(" ", 1)
         if len(parts) != 2:
-            print "Usage: invite groupname user"
+            print "Usage: %s groupname user" % command
             return
         groupname, otheruser = parts
-        status, response = sendcommand("invite", groupname, otheruser=otheruser)
+        status, response = sendcommand(command, groupname, otheruser=otheruser)
         print status, response
+
+    def do_invite(self, arg):
+        self.election_command("invite", arg)
         
     def do_kick(self, arg):
-        pass # TODO
+        self.election_command("kick", arg)
         
     def do_yes(self, arg):
-        pass # TODO
+        self.election_command("yes", arg)
         
     def do_no(self, arg):
-        pass # TODO
+        self.election_command("no", arg)
         
     def postcmd(self, stop, line):
         if line in ("q", "quit"):
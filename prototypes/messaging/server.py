@@ -2,27 +2,101 @@
 import cherrypy # CherryPy lightweight webframework. Install with: sudo pip install cherrypy
 import datetime
 import collections
+import heapq
+import threading
+
+TURNOUT = 60 # Percentage of the group that has to vote before an election is concluded early.
+MESSAGE_DAYS = 7 # Messages older than this are no longer delivered.
+MAX_BATCH = 100 # Most commands a client can send in one request.
+AWAY_MINUTES = 5 # Users who haven't polled for this long are away.
+COMMANDS = ("join", "send", "poll", "list", "invite", "kick", "yes", "no")
 
-# TODO: Expire users who haven't polled in a while, or set their status to 'away'.
-# TODO: Expire messages older than X days.
-        
 class Message(object):
-    def __init__(self, sender, recipient, message):
+    def __init__(self, sender, message, skip=None):
         self.sender = sender
-        self.recipient = recipient
+        self.skip = skip # Member who shouldn't receive this message, if any.
         self.stamp = datetime.datetime.now()
         self.message = message
-        self.delivered = False
-        
+
 class Group(object):
+    """A group and its messages, stored once per group as described in docs/Queue.txt.
+
+    Messages are appended to a buffer shared by all members. Every member has a cursor: the position of the
+    next message they will receive. Messages before the lowest cursor have been delivered to everyone and are
+    dropped, by moving 'head' forward and compacting the buffer once more than half of it has been dropped."""
     def __init__(self, name):
         self.name = name
         self.members = set() # Users in this group.
-        self.messages = [] # Messages which still have to be delivered to members of this group.
+        self.buffer = [] # Messages which may still have to be delivered to members of this group.
+        self.head = 0 # Index in buffer of the first message that hasn't been dropped.
+        self.start = 0 # Position of buffer[0]. Positions keep counting up across compactions.
+        self.ids = {} # Mapping from member -> position of the next message they will receive.
+        self.readers = collections.Counter() # Mapping from position -> number of members whose cursor is there.
+        self.low = 0 # Lowest cursor of all members.
+
+    def tail(self):
+        """Position of the next message to be sent."""
+        return self.start + len(self.buffer)
+
+    def add(self, member):
+        """Add a member, who will receive messages sent from now on."""
+        self.members.add(member)
+        if member not in self.ids:
+            self.move(member, self.tail())
+
+    def remove(self, member):
+        """Remove a member, and drop the messages only they still had to receive."""
+        self.members.discard(member)
+        if member in self.ids:
+            self.move(member, None)
+
+    def broadcast(self, sender, message, skip=None):
+        """Queue a message for all members of this group, except for 'skip'."""
+        self.buffer.append(Message(sender, message, skip))
+        if not self.ids: # Nobody will ever read it.
+            self.flush()
+
+    def read(self, member):
+        """Returns the messages the member hasn't received yet, and moves their cursor past them."""
+        messages = self.buffer[self.ids[member] - self.start:]
+        self.move(member, self.tail())
+        return [msg for msg in messages if msg.sender != member and msg.skip != member]
+
+    def move(self, member, position):
+        """Move the cursor of a member. A position of None removes the cursor."""
+        old = self.ids.pop(member, None)
+        if old is not None:
+            self.readers[old] -= 1
+            if not self.readers[old]:
+                del self.readers[old]
+        if position is not None:
+            self.ids[member] = position
+            self.readers[position] += 1
+        if old == self.low or old is None and not self.readers:
+            self.flush()
+
+    def expire(self, before):
+        """Move the cursors of all members past the messages sent before 'before', so they will be dropped."""
+        position = self.low
+        while position < self.tail() and self.buffer[position - self.start].stamp < before:
+            position += 1
+        if position > self.low:
+            for member, cursor in self.ids.items():
+                if cursor < position:
+                    self.move(member, position)
+
+    def flush(self):
+        """Drop the messages that have been delivered to every member."""
+        self.low = min(self.readers) if self.readers else self.tail()
+        self.head = self.low - self.start
+        if self.head * 2 >= len(self.buffer):
+            del self.buffer[:self.head]
+            self.start = self.low
+            self.head = 0
 
 class Election(object):
     def __init__(self, kind, username, groupname):
-        self.kind = None # "invite", "kick" or "concluded"
+        self.kind = kind # "invite", "kick" or "concluded"
         self.until = datetime.datetime.now() + datetime.timedelta(minutes=2) # Expiration date/time.
         self.yesvotes = 0
         self.novotes = 0
@@ -30,10 +104,122 @@ class Election(object):
         self.username = username # Who is this vote about?
         self.groupname = groupname # And what group does the votee wants to join (or, from which group should he be kicked?)
 
-        
+    @property
+    def key(self):
+        return (self.groupname, self.username)
+
+
+class Elections(object):
+    """Active elections, indexed by user and by group.
+
+    Votes are tallied as they arrive, so an election is concluded by the vote that pushes the turnout over
+    TURNOUT percent. Elections which run out of time are concluded by sweep(), which only looks at the
+    elections that have expired, using a heap ordered by expiration date/time."""
+    def __init__(self):
+        self.active = {} # Mapping from (groupname, username) -> Election instance
+        self.by_user = collections.defaultdict(set) # Mapping from username -> keys of elections about that user
+        self.by_group = collections.defaultdict(set) # Mapping from groupname -> keys of elections in that group
+        self.deadlines = [] # Heap of (until, sequence number, Election instance)
+        self.sequence = 0 # Breaks ties between elections that expire at the same time.
+
+    def start(self, kind, username, groupname):
+        """Start an election. Returns None if an identical election is already in progress."""
+        election = Election(kind, username, groupname)
+        if election.key in self.active:
+            return None
+        self.active[election.key] = election
+        self.by_user[username].add(election.key)
+        self.by_group[groupname].add(election.key)
+        self.sequence += 1
+        heapq.heappush(self.deadlines, (election.until, self.sequence, election))
+        return election
+
+    def vote(self, voter, username, groupname, yes):
+        """Cast a vote. Returns a note for the voter."""
+        election = self.active.get((groupname, username))
+        if election is None:
+            return "There is no election for user '%s' in group '%s'" % (username, groupname)
+        group = groups[groupname]
+        if voter not in group.members:
+            return "You are not in group '%s'" % groupname
+        if voter == username:
+            return "You can't vote in an election about yourself"
+        if voter in election.voters:
+            return "You have already voted in this election"
+        election.voters.add(voter)
+        if yes:
+            election.yesvotes += 1
+        else:
+            election.novotes += 1
+        # If enough of the group members have voted, that's a conclusion.
+        electorate = len(group.members - set([username]))
+        if (election.yesvotes + election.novotes) * 100 >= TURNOUT * electorate:
+            self.conclude(election)
+        return "Your vote has been counted"
+
+    def sweep(self, now=None):
+        """Conclude all elections that have expired."""
+        now = now or datetime.datetime.now()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            until, sequence, election = heapq.heappop(self.deadlines)
+            if election.kind != "concluded": # Elections concluded by a vote are still on the heap.
+                self.conclude(election)
+
+    def conclude(self, election):
+        """Apply the verdict of an election and notify the users concerned."""
+        username, groupname = election.username, election.groupname
+        group = groups[groupname]
+        if election.yesvotes >= election.novotes:
+            # It's a YES.
+            if election.kind == "invite":
+                group.add(username)
+                users[username].add(group)
+                note = "You have been added to the group '%s', which now has %d users" % (groupname, len(group.members))
+                group.broadcast("system", "User '%s' has joined the group '%s'" % (username, groupname), skip=username)
+            elif election.kind == "kick":
+                group.remove(username)
+                users[username].discard(group)
+                note = "You have been kicked from the group '%s'" % groupname
+                group.broadcast("system", "User '%s' has been kicked from the group '%s'" % (username, groupname))
+        else:
+            # It's a NO.
+            if election.kind == "invite":
+                note = "You have been denied access to the group '%s'" % groupname
+            elif election.kind == "kick":
+                note = "The vote to kick you from %s has failed" % groupname
+        notes[username].append((groupname, note))
+        election.kind = "concluded"
+        del self.active[election.key]
+        self.by_user[username].discard(election.key)
+        if not self.by_user[username]:
+            del self.by_user[username]
+        self.by_group[groupname].discard(election.key)
+        if not self.by_group[groupname]:
+            del self.by_group[groupname]
+
+
 groups = {} # Known groups, mapping from groupname -> Group instance
 users = collections.defaultdict(set) # Known users, mapping from username -> Group instances they're in
-elections = {} # Active elections, mapping from (groupname, username) -> Election instance
+elections = Elections() # Active elections
+notes = collections.defaultdict(list) # Outcomes of elections, mapping from username -> (groupname, note) tuples
+seen = collections.OrderedDict() # Online users, mapping from username -> datetime of their last poll, least recent first
+away = set() # Users who haven't polled for AWAY_MINUTES
+lock = threading.RLock() # Serializes commands and the election sweep.
+
+def call_election(kind, username, groupname):
+    """Start an election and ask the members of the group to vote on it."""
+    election = elections.start(kind, username, groupname)
+    if election is None:
+        note = "An election for user '%s', group '%s' is already in progress" % (username, groupname)
+        return None, note
+    # Send an appropriate message to users in this group.
+    expiration = election.until.strftime("%H:%M:%S")
+    if kind == "invite":
+        message = "User '%s' has asked to join the group '%s'. Use yes or no to vote for it. This election will run until %s" % (username, groupname, expiration)
+    else:
+        message = "There is a vote to kick user '%s' from the group '%s'. Use yes or no to vote for it. This election will run until %s" % (username, groupname, expiration)
+    groups[groupname].broadcast("system", message, skip=username)
+    return election, expiration
 
 def join(data):
     """Process the join command"""
@@ -42,96 +228,108 @@ def join(data):
     if "user" not in data:
         return {"result": "error", "message": "user parameter missing"}
     username = data["user"]
-    groupname = data["group"] # TODO check for empty strings    
+    groupname = data["group"] # TODO check for empty strings
     note = ""
     if groupname in groups:
         group = groups[groupname]
         if username in group.members:
             note = "You are already in the group '%s'" % groupname
         else:
-            # See if an identical election is in progress.
-            key = (groupname, username)
-            if key in elections:
-                note = "An election for user '%s', group '%s' is already in progress" % (username, groupname)
-                return {"result": "error", "note": note}
             # Initiate an election for user to join the group.
-            election = Election("invite", username, groupname)
-            elections[key] = election
-            # Send an appropriate message to users in this group.
-            expiration = election.until.strftime("%H:%M:%S")
-            message = "User '%s' has asked to join the group '%s'. Use yes or no to vote for it. This election will run until %s" % (username, groupname, expiration)
-            for member in group.members:
-                msg = Message("system", member, message)
-                group.messages.append(msg)
+            election, expiration = call_election("invite", username, groupname)
+            if election is None:
+                return {"result": "error", "note": expiration}
             # And also let the user who wants to join the group know about it
             note = "Your join request has been send to %d member(s) of '%s'. This election will run until %s" % (len(group.members), groupname, expiration)
     else:
         # Group doesn't exist yet. Create a new group with the given name, and put the user in it.
         group = Group(groupname)
         groups[groupname] = group
-        group.members.add(username)
+        group.add(username)
         users[username].add(group)
         note = "You have created a new group '%s'" % groupname
     return {"result": "success", "note": note}
-    
-    
+
+
+def election_command(data):
+    """Check the parameters shared by the invite, kick, yes and no commands."""
+    for parameter in ("group", "user", "otheruser"):
+        if parameter not in data:
+            return "%s parameter missing" % parameter
+    if data["group"] not in groups:
+        return "Group '%s' doesn't exist" % data["group"]
+    if data["user"] not in groups[data["group"]].members:
+        return "You are not in group '%s'" % data["group"]
+    return None
+
+
+def invite(data):
+    """Process the invite command"""
+    error = election_command(data)
+    if error:
+        return {"result": "error", "message": error}
+    groupname, otheruser = data["group"], data["otheruser"]
+    if otheruser in groups[groupname].members:
+        return {"result": "error", "message": "User '%s' is already in the group '%s'" % (otheruser, groupname)}
+    election, expiration = call_election("invite", otheruser, groupname)
+    if election is None:
+        return {"result": "error", "note": expiration}
+    return {"result": "success", "note": "An election to invite '%s' will run until %s" % (otheruser, expiration)}
+
+
+def kick(data):
+    """Process the kick command"""
+    error = election_command(data)
+    if error:
+        return {"result": "error", "message": error}
+    groupname, otheruser = data["group"], data["otheruser"]
+    if otheruser not in groups[groupname].members:
+        return {"result": "error", "message": "User '%s' is not in the group '%s'" % (otheruser, groupname)}
+    election, expiration = call_election("kick", otheruser, groupname)
+    if election is None:
+        return {"result": "error", "note": expiration}
+    return {"result": "success", "note": "An election to kick '%s' will run until %s" % (otheruser, expiration)}
+
+
+def yes(data):
+    """Process the yes command"""
+    error = election_command(data)
+    if error:
+        return {"result": "error", "message": error}
+    note = elections.vote(data["user"], data["otheruser"], data["group"], True)
+    return {"result": "success", "note": note}
+
+
+def no(data):
+    """Process the no command"""
+    error = election_command(data)
+    if error:
+        return {"result": "error", "message": error}
+    note = elections.vote(data["user"], data["otheruser"], data["group"], False)
+    return {"result": "success", "note": note}
+
+
 def poll(data):
     """Process the poll command."""
     if "user" not in data:
         return {"result": "error", "message": "User parameter missing"}
     # See what queued messages should be returned.
-    username = data["user"]    
+    username = data["user"]
+    seen.pop(username, None) # Move the user to the end, as the most recent.
+    seen[username] = datetime.datetime.now()
+    away.discard(username)
+    content = [("system", groupname, note) for groupname, note in notes.pop(username, [])]
     if username not in users:
         users[username] = set()
-        return {"result": "error", "message": "You are not in any groups. Use the join command first"}
-
-    # See if this user was engaged in election(s), and if so, if it has been concluded yet.
-    for key, election in elections.iteritems():
-        if election.username == username:
-            concluded = False
-            # Has the expiry date/time been reached?
-            if datetime.datetime.now() > election.until:
-                concluded = True
-            # If more than 60% of the group members have voted, that's a conclusion, too.
-            groupname = election.groupname
-            group = groups[groupname]
-            if len(group.members):
-                turnout = float(election.yesvotes + election.novotes) / len(group.members) * 100
-            else:
-                turnout = 100
-            print "Turnout:", turnout
-            if turnout >= 60:
-                concluded = True
-            # The verdict?
-            if concluded:
-                if election.yesvotes >= election.novotes:
-                    # It's a YES.
-                    if election.kind == "invite":
-                        group.members.add(username)
-                        users[username].add(group)
-                        note = "You have been added to the group '%s', which now has %d users" % (groupname, len(group.members))
-                    elif election.kind == "kick":
-                        pass # TODO
-                else:
-                    # It's a NO.
-                    if election.kind == "invite":
-                        note = "You have been denied access to the group '%s'" % groupname
-                    elif election.kind == "kick":
-                        note = "The vote to kick you from %s has failed" % groupname
-                election.kind = "concluded"
-                # TODO: Send note as message to user
-                del elections[key] # TODO: global sweep outside of this loop, notify users who are still online that their invitation was terminated without conclusion.
-
-    content = []
+        if not content:
+            return {"result": "error", "message": "You are not in any groups. Use the join command first"}
+
     for group in users[username]:
-        for msg in group.messages:
-            if msg.recipient == username:
-                content.append((msg.sender, group.name, msg.message))
-                msg.delivered = True
-        # Prune delivered messages. TODO: Also expire messages that are too old.
-        group.messages = [msg for msg in group.messages if not msg.delivered]
-    return {"result": "success", "messages": content} # list of tuples of ("from", "group", "message")
-    
+        for msg in group.read(username):
+            content.append((msg.sender, group.name, msg.message))
+    pending = sorted(groupname for groupname, _ in elections.by_user.get(username, ())) # Groups still voting about this user.
+    return {"result": "success", "messages": content, "elections": pending} # list of tuples of ("from", "group", "message")
+
 
 def send(data):
     """Process the send command"""
@@ -151,42 +349,82 @@ def send(data):
     group = groups[groupname]
     if username not in group.members:
         return {"result": "error", "message": "You are not in group '%s'" % groupname}
-    # Create a Messages for all other members of this group.
-    for member in group.members:
-        if member == username:
-            continue # Don't send messages to ourself.
-        msg = Message(username, member, message)
-        group.messages.append(msg)
+    # Store the message once for all other members of this group.
+    group.broadcast(username, message) # Members don't receive messages they sent themselves.
     return {"result": "success"}
 
 
 def list(data):
-    """Process the list command"""    
+    """Process the list command"""
     grouplist = []
     for groupname in sorted(groups.keys()):
         group = groups[groupname]
-        grouplist.append("%s: %d users" % (groupname, len(group.members)))
+        online = sum(1 for member in group.members if member in seen)
+        grouplist.append("%s: %d users, %d online, %d elections" % (groupname, len(group.members), online, len(elections.by_group.get(groupname, ()))))
     return {"result": "success", "groups": grouplist}
-    
-    
+
+
+def sweep():
+    """Conclude expired elections. Runs once a second in the background."""
+    with lock:
+        elections.sweep()
+
+
+def expire():
+    """Drop messages older than MESSAGE_DAYS. Runs once a minute in the background."""
+    before = datetime.datetime.now() - datetime.timedelta(days=MESSAGE_DAYS)
+    with lock:
+        for group in groups.values():
+            group.expire(before)
+
+
+def mark_away():
+    """Mark users who haven't polled for AWAY_MINUTES as away. Runs once a minute in the background.
+
+    Users are kept in the order they last polled in, so only the users who are marked away are looked at."""
+    before = datetime.datetime.now() - datetime.timedelta(minutes=AWAY_MINUTES)
+    with lock:
+        while seen:
+            username, stamp = next(seen.iteritems())
+            if stamp >= before:
+                break
+            del seen[username]
+            away.add(username)
+
+
+def process(data):
+    """Run a single command and return its result. The lock must be held."""
+    command = data.get("command") if isinstance(data, dict) else None
+    if command in COMMANDS:
+        return globals()[command](data)
+    return {"result": "error", "message": "Unknown or missing command"}
+
+
 class VoterChat(object):
-    """Simple webapp that only accepts POSTs of JSON and diverts them to a processing function. Also returns JSON to the client."""
+    """Simple webapp that only accepts POSTs of JSON and diverts them to a processing function. Also returns JSON to the client.
+
+    The JSON is either a single command, or a list of up to MAX_BATCH commands which are run in order, for example
+    a send followed by a poll. A list of commands gets a list of their results, in the same order."""
     @cherrypy.expose
     @cherrypy.tools.json_out()
-    @cherrypy.tools.json_in()    
+    @cherrypy.tools.json_in()
     def api(self):
         if cherrypy.request.method != "POST":
             raise cherrypy.HTTPError(405) # Only accept POST requests.
         data = cherrypy.request.json
-        command = data["command"]
-        if command in ("join", "send", "poll", "list", "invite", "yes", "no"):
-            result = globals()[command](data)
-        else:
-            result = {"result": "error", "message": "Unknown or missing command"}
-        return result        
-        
-        
+        if not isinstance(data, collections.MutableSequence): # A JSON array. The name 'list' is taken by a command.
+            with lock:
+                return process(data)
+        if len(data) > MAX_BATCH:
+            return {"result": "error", "message": "At most %d commands can be sent at once" % MAX_BATCH}
+        with lock:
+            return [process(command) for command in data]
+
+
 if __name__ == "__main__":
     print "\n\nNow start one or more clients using 'python client.py' and join a group on this server using the 'join' command.\n\n"
     conf = {"/": {}}
+    cherrypy.process.plugins.Monitor(cherrypy.engine, sweep, frequency=1).subscribe()
+    cherrypy.process.plugins.Monitor(cherrypy.engine, expire, frequency=60).subscribe()
+    cherrypy.process.plugins.Monitor(cherrypy.engine, mark_away, frequency=60).subscribe()
     cherrypy.quickstart(VoterChat(), "/", conf)
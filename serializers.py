@@ -0,0 +1,212 @@
+"""
+Copyright 2014 VoterChat
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import struct
+import time
+import zlib
+from datetime import datetime
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.frame as lz4
+except ImportError:
+    lz4 = None
+
+# The first byte of a packed message holds the format
+# in the high nibble and the compression in the low one.
+FORMAT_STRUCT = 1
+FORMAT_MSGPACK = 2
+
+COMPRESS_NONE = 0
+COMPRESS_ZLIB = 1
+COMPRESS_LZ4 = 2
+
+# Stamp, then the lengths of the sender, group and content.
+HEADER = struct.Struct(">qHHI")
+
+def compress(kind, data):
+    if kind == COMPRESS_ZLIB:
+        return zlib.compress(data)
+    if kind == COMPRESS_LZ4:
+        return lz4.compress(data)
+    return data
+
+def decompress(kind, data):
+    if kind == COMPRESS_ZLIB:
+        return zlib.decompress(data)
+    if kind == COMPRESS_LZ4:
+        return lz4.decompress(data)
+    return data
+
+def encode(value):
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return str(value)
+
+def parse_stamp(value):
+    """
+    Returns a stamp in milliseconds since the epoch, given either
+    as a number or as the date messages were stamped with before
+    stamps were stored in milliseconds.
+    """
+    if value.isdigit():
+        return int(value)
+    stamp = datetime.strptime(value.split(".")[0], "%Y-%m-%d %H:%M:%S")
+    return int(time.mktime(stamp.timetuple()) * 1000)
+
+class Serializer(object):
+    """
+    Packs the fields of a message into a single value.
+
+    Content longer than `threshold` bytes is compressed. Every
+    format is a subclass setting `format` and implementing
+    `pack(stamp, sender, group, content)`, which returns the
+    packed fields, and the static method `unpack(body)`, which
+    returns them as a [stamp, sender, group, content] list.
+    """
+    packed = True
+    format = None
+
+    def __init__(self, compression=None, threshold=None):
+        """
+        Creates a serializer given the following parameters:
+        * compression - "zlib", "lz4" or None for no compression.
+        * threshold - Size of the content in bytes above which
+                      it is compressed.
+        """
+        if compression == "lz4" and lz4 is None:
+            raise ImportError("Compression 'lz4' requires the lz4 package.")
+        self.compression = {
+            None: COMPRESS_NONE,
+            "zlib": COMPRESS_ZLIB,
+            "lz4": COMPRESS_LZ4
+        }[compression]
+        self.threshold = threshold
+
+    def dumps(self, fields):
+        """
+        Returns the packed value of a message given its fields.
+        """
+        content = encode(fields["content"])
+        kind = COMPRESS_NONE
+        if self.compression and len(content) > self.threshold:
+            kind = self.compression
+            content = compress(kind, content)
+        body = self.pack(
+            int(fields["stamp"]),
+            encode(fields["sender"]),
+            encode(fields["group"]),
+            content
+        )
+        return chr(self.format << 4 | kind) + body
+
+class StructSerializer(Serializer):
+    """
+    Packs a fixed header followed by the raw fields.
+    """
+    format = FORMAT_STRUCT
+
+    def pack(self, stamp, sender, group, content):
+        header = HEADER.pack(stamp, len(sender), len(group), len(content))
+        return header + sender + group + content
+
+    @staticmethod
+    def unpack(body):
+        stamp, sender, group, content = HEADER.unpack_from(body)
+        start = HEADER.size
+        fields = []
+        for size in (sender, group, content):
+            fields.append(body[start:start + size])
+            start += size
+        return [stamp] + fields
+
+class MsgpackSerializer(Serializer):
+    """
+    Packs the fields as a msgpack array.
+    """
+    format = FORMAT_MSGPACK
+
+    def __init__(self, compression=None, threshold=None):
+        if msgpack is None:
+            raise ImportError(
+                "Serializer 'msgpack' requires the msgpack package."
+            )
+        Serializer.__init__(self, compression, threshold)
+
+    def pack(self, stamp, sender, group, content):
+        return msgpack.packb([stamp, sender, group, content], use_bin_type=True)
+
+    @staticmethod
+    def unpack(body):
+        return msgpack.unpackb(body, raw=True)
+
+class HashSerializer(object):
+    """
+    Stores every field of a message in a hash.
+    """
+    packed = False
+
+    def __init__(self, compression=None, threshold=None):
+        pass
+
+SERIALIZERS = {
+    "hash": HashSerializer,
+    "struct": StructSerializer,
+    "msgpack": MsgpackSerializer
+}
+
+FORMATS = {
+    FORMAT_STRUCT: StructSerializer,
+    FORMAT_MSGPACK: MsgpackSerializer
+}
+
+def get_serializer(name, compression=None, threshold=None):
+    """
+    Returns the serializer with the given name.
+    """
+    return SERIALIZERS[name](compression, threshold)
+
+def loads(value):
+    """
+    Returns the fields of a message given its packed value.
+
+    The format and compression are read from the value itself,
+    so values packed by any serializer can be read.
+    """
+    flags = ord(value[0])
+    stamp, sender, group, content = FORMATS[flags >> 4].unpack(value[1:])
+    return {
+        "sender": sender.decode("utf-8"),
+        "content": decompress(flags & 0xf, content).decode("utf-8"),
+        "stamp": stamp,
+        "group": group.decode("utf-8")
+    }
+
+def loads_hash(fields):
+    """
+    Returns the fields of a message stored as a hash, with
+    the same types as `loads` returns.
+    """
+    return {
+        "sender": fields["sender"].decode("utf-8"),
+        "content": fields["content"].decode("utf-8"),
+        "stamp": parse_stamp(fields["stamp"]),
+        "group": fields.get("group", "").decode("utf-8")
+    }
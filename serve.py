@@ -0,0 +1,30 @@
+"""
+Copyright 2014 VoterChat
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+# Sockets have to be patched before anything else is imported,
+# so that every request and database call runs in a greenlet.
+from gevent import monkey
+monkey.patch_all()
+
+from gevent.pywsgi import WSGIServer
+
+import config
+from main import app
+
+if __name__ == "__main__":
+    server = WSGIServer((config.SERVER_HOST, config.SERVER_PORT), app)
+    print "Serving on %s:%d" % (config.SERVER_HOST, config.SERVER_PORT)
+    server.serve_forever()
@@ -0,0 +1,177 @@
+"""
+Copyright 2014 VoterChat
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import bisect
+import hashlib
+import random
+from collections import OrderedDict
+
+import redis
+
+# Points every node has on the ring, to spread keys evenly.
+REPLICAS = 160
+
+def hash_tag(key):
+    """
+    Returns the part of the key keys are routed by.
+
+    As in Redis Cluster, if the key contains "{...}", only the
+    text between the braces is used, so that keys sharing it are
+    stored on the same node. Otherwise the whole key is used.
+    """
+    start = key.find("{")
+    if start != -1:
+        end = key.find("}", start + 1)
+        if end > start + 1:
+            return key[start + 1:end]
+    return key
+
+def position(value):
+    """
+    Returns the position of the value on the ring. Unicode is
+    hashed as UTF-8, as redis-py sends it, so that a name routes
+    to the same node whether it is given as bytes or unicode.
+    """
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    return int(hashlib.md5(value).hexdigest()[:8], 16)
+
+class Ring(object):
+    """
+    Consistent hash ring mapping keys to node IDs. Adding or
+    removing a node only moves the keys of that node.
+    """
+
+    def __init__(self, node_ids):
+        points = []
+        for node_id in node_ids:
+            for i in range(REPLICAS):
+                points.append((position("%s-%d" % (node_id, i)), node_id))
+        points.sort()
+        self.positions = [point for point, _ in points]
+        self.node_ids = [node_id for _, node_id in points]
+
+    def node_id(self, key):
+        """
+        Returns the ID of the node the key is stored on.
+        """
+        i = bisect.bisect(self.positions, position(hash_tag(key)))
+        return self.node_ids[i % len(self.node_ids)]
+
+class Script(object):
+    """
+    Lua script which is run on the node of its first key.
+    All of its keys have to be stored on that node.
+    """
+
+    def __init__(self, sharded, script):
+        self.sharded = sharded
+        self.script = sharded.clients.values()[0].register_script(script)
+
+    def __call__(self, keys=[], args=[], client=None):
+        client = client or self.sharded.node(keys[0])
+        return self.script(keys=keys, args=args, client=client)
+
+class ShardedRedis(object):
+    """
+    Redis client spreading keys across several nodes.
+
+    Commands called on it are sent to the node of their first
+    argument, so commands on several keys must only be given
+    keys stored on the same node, which hash tags ensure.
+    Commands which are not about a key, such as SCAN, have to
+    be sent to every node in `nodes()`.
+    """
+
+    def __init__(self, nodes, max_connections, timeout,
+                 connection_class=redis.Connection):
+        """
+        Creates a client given the following parameters:
+        * nodes - List of dicts with the "id", "host", "port"
+                  and "db" of every node.
+        * max_connections - Maximum connections to every node.
+        * timeout - Seconds to wait for a free connection.
+
+        Parameters:
+        * connection_class - Class of the connections to the nodes.
+        """
+        self.clients = OrderedDict()
+        for node in nodes:
+            pool = redis.BlockingConnectionPool(
+                host=node["host"],
+                port=node["port"],
+                db=node["db"],
+                max_connections=max_connections,
+                timeout=timeout,
+                connection_class=connection_class
+            )
+            self.clients[node["id"]] = redis.StrictRedis(connection_pool=pool)
+        self.ring = Ring(self.clients.keys())
+
+    def node(self, key):
+        """
+        Returns the client of the node the key is stored on.
+        """
+        return self.clients[self.ring.node_id(key)]
+
+    def nodes(self):
+        """
+        Returns the clients of all nodes.
+        """
+        return self.clients.values()
+
+    def random_node(self):
+        """
+        Returns the ID and client of a node chosen at random.
+        """
+        return random.choice(self.clients.items())
+
+    def partition(self, items, key=None):
+        """
+        Returns (client, items) tuples, grouping keys by the
+        node they are stored on. Items keep their order.
+
+        Parameters:
+        * key - Function returning the key of an item.
+                Default is for the items to be keys.
+        """
+        groups = OrderedDict()
+        for item in items:
+            node_id = self.ring.node_id(key(item) if key else item)
+            groups.setdefault(node_id, []).append(item)
+        return [
+            (self.clients[node_id], node_items)
+            for node_id, node_items in groups.iteritems()
+        ]
+
+    def pipeline(self, key, transaction=True):
+        """
+        Returns a pipeline to the node the key is stored on.
+        """
+        return self.node(key).pipeline(transaction=transaction)
+
+    def register_script(self, script):
+        return Script(self, script)
+
+    def flushdb(self):
+        for client in self.nodes():
+            client.flushdb()
+
+    def __getattr__(self, name):
+        def command(key, *args, **kwargs):
+            return getattr(self.node(key), name)(key, *args, **kwargs)
+        command.__name__ = name
+        return command
@@ -0,0 +1,47 @@
+"""
+Copyright 2014 VoterChat
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+# Concludes elections which have run out of time and marks users who have
+# stopped polling as away. Sweeps only read the elections past their
+# deadline and a bounded batch of idle users, so this can run in one or
+# more processes next to the API.
+
+import time
+
+import config
+import logs
+import models
+
+def run_forever():
+    """
+    Sweeps elections every `config.ELECTION_SWEEP_INTERVAL` seconds
+    and presence every `config.PRESENCE_SWEEP_INTERVAL` seconds.
+    """
+    presence_at = 0
+    while True:
+        concluded = models.sweep_elections()
+        if concluded:
+            logs.event("sweep_elections", concluded=concluded)
+
+        if time.time() >= presence_at:
+            presence_at = time.time() + config.PRESENCE_SWEEP_INTERVAL
+            away, forgotten = models.sweep_presence()
+            if away or forgotten:
+                logs.event("sweep_presence", away=away, forgotten=forgotten)
+        time.sleep(config.ELECTION_SWEEP_INTERVAL)
+
+if __name__ == "__main__":
+    run_forever()
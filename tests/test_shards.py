@@ -0,0 +1,217 @@
+"""
+Copyright 2014 VoterChat
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+# Tests of the routing of keys across nodes. The ring and partitioning run
+# without a server. The tests of sending to users on several nodes need two
+# Redis servers, given as host:port pairs, whose databases are flushed:
+#
+#   VOTERCHAT_TEST_NODES=localhost:6380,localhost:6381 \
+#       python -m unittest discover tests
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import config
+import shards
+
+TEST_NODES = os.environ.get("VOTERCHAT_TEST_NODES")
+
+def two_nodes():
+    """
+    Returns the configuration of two nodes, from TEST_NODES
+    if it is set.
+    """
+    addresses = (TEST_NODES or "localhost:6380,localhost:6381").split(",")
+    nodes = []
+    for node_id, address in enumerate(addresses):
+        host, port = address.split(":")
+        nodes.append({"id": node_id, "host": host, "port": int(port), "db": 0})
+    return nodes
+
+def names_on(ring, node_id, prefix, count):
+    """
+    Returns `count` usernames whose keys are on the given node.
+    """
+    names = []
+    i = 0
+    while len(names) < count:
+        name = "%s%d" % (prefix, i)
+        if ring.node_id("user:{%s}" % name) == node_id:
+            names.append(name)
+        i += 1
+    return names
+
+class HashTagTest(unittest.TestCase):
+
+    def test_tag(self):
+        self.assertEqual(shards.hash_tag("user:{alice}:queue"), "alice")
+        self.assertEqual(shards.hash_tag("message:{42}"), "42")
+
+    def test_whole_key(self):
+        self.assertEqual(shards.hash_tag("presence:online"), "presence:online")
+        self.assertEqual(shards.hash_tag("user:{}:queue"), "user:{}:queue")
+        self.assertEqual(shards.hash_tag("user:{alice"), "user:{alice")
+
+class RingTest(unittest.TestCase):
+
+    def test_keys_sharing_a_tag(self):
+        ring = shards.Ring([0, 1, 2])
+        for name in ("alice", "bob", "carol"):
+            self.assertEqual(
+                ring.node_id("user:{%s}" % name),
+                ring.node_id("user:{%s}:queue" % name)
+            )
+
+    def test_unicode(self):
+        ring = shards.Ring([0, 1])
+        key = u"user:{jos\xe9}"
+        self.assertEqual(
+            shards.position(key), shards.position(key.encode("utf-8"))
+        )
+        self.assertEqual(ring.node_id(key), ring.node_id(key.encode("utf-8")))
+
+    def test_spread(self):
+        ring = shards.Ring([0, 1])
+        on_first = sum(
+            ring.node_id("user:{user%d}" % i) == 0 for i in range(1000)
+        )
+        self.assertTrue(300 < on_first < 700)
+
+    def test_adding_a_node(self):
+        before = shards.Ring([0, 1])
+        after = shards.Ring([0, 1, 2])
+        for i in range(1000):
+            key = "user:{user%d}" % i
+            if after.node_id(key) != before.node_id(key):
+                self.assertEqual(after.node_id(key), 2)
+
+class ShardedRedisTest(unittest.TestCase):
+
+    def setUp(self):
+        # Clients only connect when a command is sent.
+        self.sharded = shards.ShardedRedis(
+            two_nodes(), max_connections=2, timeout=1
+        )
+
+    def test_node(self):
+        for name in ("alice", "bob", "carol"):
+            key = "user:{%s}" % name
+            self.assertIs(
+                self.sharded.node(key),
+                self.sharded.clients[self.sharded.ring.node_id(key)]
+            )
+
+    def test_partition(self):
+        keys = ["user:{user%d}" % i for i in range(20)]
+        nodes = self.sharded.partition(keys)
+        self.assertEqual(len(nodes), 2)
+        partitioned = []
+        for client, node_keys in nodes:
+            for key in node_keys:
+                self.assertIs(self.sharded.node(key), client)
+            self.assertEqual(node_keys, sorted(node_keys, key=keys.index))
+            partitioned.extend(node_keys)
+        self.assertEqual(sorted(partitioned), sorted(keys))
+
+    def test_partition_by_key(self):
+        names = ["user%d" % i for i in range(20)]
+        for client, node_names in self.sharded.partition(
+                names, key=lambda name: "user:{%s}" % name):
+            for name in node_names:
+                self.assertIs(self.sharded.node("user:{%s}" % name), client)
+
+@unittest.skipUnless(TEST_NODES, "VOTERCHAT_TEST_NODES is not set")
+class SendNodesTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        config.REDIS_NODES = two_nodes()
+        import models
+        cls.models = models
+
+    def setUp(self):
+        self.models.r.flushdb()
+        self.models.flushdb()
+
+    def new_users(self, names):
+        for name in names:
+            self.models.User(name, email="%s@example.com" % name).new()
+
+    def test_send_to_several_nodes(self):
+        ring = self.models.r.ring
+        names = names_on(ring, 0, "first", 2) + names_on(ring, 1, "second", 2)
+        self.new_users(names)
+        msg = self.models.send_message("first0", "Hey Dude!", names)
+        count_key = "%s:count" % msg.key
+        self.assertEqual(self.models.r.get(count_key), str(len(names)))
+
+        for name in names:
+            messages = self.models.User(name).poll()
+            self.assertEqual([data["id"] for data in messages], [msg.id])
+        self.assertFalse(self.models.r.exists(msg.key))
+        self.assertFalse(self.models.r.exists(count_key))
+
+    def test_missing_recipient(self):
+        ring = self.models.r.ring
+        names = names_on(ring, 0, "first", 1) + names_on(ring, 1, "second", 1)
+        self.new_users(names[:1])
+        with self.assertRaises(ValueError):
+            self.models.send_message("first0", "Hey Dude!", names)
+        self.assertEqual(self.models.User(names[0]).poll(), [])
+
+@unittest.skipUnless(TEST_NODES, "VOTERCHAT_TEST_NODES is not set")
+class GroupNodesTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        config.REDIS_NODES = two_nodes()
+        import models
+        cls.models = models
+
+    def setUp(self):
+        self.models.r.flushdb()
+        self.models.flushdb()
+
+    def test_missing_creator(self):
+        group = self.models.Group("chat")
+        with self.assertRaises(ValueError):
+            group.new("nobody")
+        self.assertFalse(self.models.r.exists(group.key))
+
+    def test_expired_election_without_votes(self):
+        for name in ("alice", "bob"):
+            self.models.User(name, email="%s@example.com" % name).new()
+        group = self.models.Group("chat")
+        group.new("alice")
+        deadline = self.models.Election("chat", "bob").start("invite", "bob")
+        self.assertEqual(self.models.sweep_elections(deadline + 1), 1)
+        self.assertEqual(group.members(), ["alice"])
+
+    def test_delete_user_with_stale_group(self):
+        for name in ("alice", "bob"):
+            self.models.User(name, email="%s@example.com" % name).new()
+        self.models.Group("chat").new("alice")
+        self.models.r.sadd("user:{alice}:groups", "gone")
+        msg = self.models.send_message("bob", "Hey Dude!", ["alice"])
+        self.models.User("alice").delete()
+        self.assertFalse(self.models.r.exists(msg.key))
+        self.assertFalse(self.models.r.exists("user:{alice}:groups"))
+
+if __name__ == "__main__":
+    unittest.main()